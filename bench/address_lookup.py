@@ -0,0 +1,109 @@
+# Address lookup benchmark: the old exact check (append " tuman", then scan
+# the region's list) versus match_place on the normalized/trigram index, for
+# exact input and for the variants users actually type.
+#
+#   python bench/address_lookup.py [lookups]
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+ADDRESS = {
+    'Toshkent shahri': ['Bektemir tuman', 'Chilonzor tuman', 'Mirobod tuman', "Mirzo Ulug'bek tuman", 'Olmazor tuman', 'Sergeli tuman',
+                        'Shayxontohur tuman', 'Uchtepa tuman', 'Yakkasaroy tuman', 'Yashnobod tuman', 'Yangihayot tuman', 'Yunusobod tuman'],
+    'Toshkent viloyati': ['Bekobod tuman', "Bo'ka tuman", "Bo'stonliq tuman", 'Chinoz tuman', 'Qibray tuman', 'Ohangaron tuman',
+                          "Oqqo'rg'on tuman", 'Parkent tuman', 'Piskent tuman', 'Quyichirchiq tuman', "O'rtachirchiq tuman", 'Yuqorichirchiq tuman',
+                          'Zangiota tuman', 'Toshkent tuman', 'Yangiyo\'l tuman'],
+    'Samarqand viloyati': ["Bulung'ur tuman", 'Ishtixon tuman', 'Jomboy tuman', "Kattaqo'rg'on tuman", "Qo'shrabot tuman", 'Narpay tuman',
+                           'Nurobod tuman', 'Oqdaryo tuman', 'Paxtachi tuman', 'Payariq tuman', "Pastdarg'om tuman", 'Samarqand tuman',
+                           'Tayloq tuman', 'Urgut tuman'],
+    "Farg'ona viloyati": ['Oltiariq tuman', "Bag'dod tuman", 'Beshariq tuman', 'Buvayda tuman', "Dang'ara tuman", "Farg'ona tuman",
+                          'Furqat tuman', "Qo'shtepa tuman", 'Quva tuman', 'Rishton tuman', "So'x tuman", 'Toshloq tuman',
+                          "Uchko'prik tuman", "O'zbekiston tuman", 'Yozyovon tuman'],
+    'Buxoro viloyati': ['Olot tuman', 'Buxoro tuman', "G'ijduvon tuman", 'Jondor tuman', 'Kogon tuman', "Qorako'l tuman",
+                        'Qorovulbozor tuman', 'Peshku tuman', 'Romitan tuman', 'Shofirkon tuman', 'Vobkent tuman'],
+}
+
+LATIN_TO_CYRILLIC = [("o'", 'ў'), ("g'", 'ғ'), ('sh', 'ш'), ('ch', 'ч'), ('yo', 'ё'), ('yu', 'ю'), ('ya', 'я'), ('a', 'а'), ('b', 'б'),
+                     ('d', 'д'), ('e', 'е'), ('f', 'ф'), ('g', 'г'), ('h', 'ҳ'), ('i', 'и'), ('j', 'ж'), ('k', 'к'), ('l', 'л'),
+                     ('m', 'м'), ('n', 'н'), ('o', 'о'), ('p', 'п'), ('q', 'қ'), ('r', 'р'), ('s', 'с'), ('t', 'т'), ('u', 'у'),
+                     ('v', 'в'), ('x', 'х'), ('y', 'й'), ('z', 'з')]
+
+def to_cyrillic(text):
+    text = text.lower()
+    out = ''
+    while text:
+        for latin, cyrillic in LATIN_TO_CYRILLIC:
+            if text.startswith(latin):
+                out += cyrillic
+                text = text[len(latin):]
+                break
+        else:
+            out += text[0]
+            text = text[1:]
+    return out.capitalize()
+
+def typo(text, rng):
+    idx = rng.randrange(1, len(text) - 1)
+    edit = rng.choice(('drop', 'swap', 'double'))
+    if edit == 'drop':
+        return text[:idx] + text[idx + 1:]
+    if edit == 'swap':
+        return text[:idx - 1] + text[idx] + text[idx - 1] + text[idx + 1:]
+    return text[:idx] + text[idx] + text[idx:]
+
+VARIANTS = {
+    'exact': lambda name, rng: name,
+    'no suffix': lambda name, rng: name.rsplit(' ', 1)[0],
+    'lowercase': lambda name, rng: name.rsplit(' ', 1)[0].lower(),
+    'apostrophe': lambda name, rng: name.replace("'", 'ʻ').replace(' tuman', ''),
+    'cyrillic': lambda name, rng: to_cyrillic(name.rsplit(' ', 1)[0]) + ' тумани',
+    'typo': lambda name, rng: typo(name.rsplit(' ', 1)[0], rng),
+}
+
+def old_lookup(address, region, text):
+    district = text
+    if 'tuman' not in district.lower():
+        district += ' tuman'
+    return district if district in address[region] else None
+
+def main():
+    lookups = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    os.chdir(tempfile.mkdtemp())
+    os.environ.setdefault('API_TOKEN', '0:bench')
+    import main as bot_main
+
+    started = time.perf_counter()
+    indexes = {region: bot_main.build_place_index(districts) for region, districts in ADDRESS.items()}
+    print(f"index build: {(time.perf_counter() - started) * 1000:.2f} ms for {sum(map(len, ADDRESS.values()))} districts")
+
+    rng = random.Random(1)
+    pairs = [(region, name) for region, districts in ADDRESS.items() for name in districts]
+    print(f"{'input':<12} {'old us':>8} {'old ok':>7} {'new us':>8} {'new ok':>7} {'suggested':>9}")
+    for label, variant in VARIANTS.items():
+        queries = [(region, name, variant(name, rng)) for region, name in (rng.choice(pairs) for _ in range(lookups))]
+
+        started = time.perf_counter()
+        old_ok = sum(1 for region, name, text in queries if old_lookup(ADDRESS, region, text) == name)
+        old_time = (time.perf_counter() - started) / lookups
+
+        started = time.perf_counter()
+        results = [(name, bot_main.match_place(indexes[region], text)) for region, name, text in queries]
+        new_time = (time.perf_counter() - started) / lookups
+        new_ok = sum(1 for name, (match, _) in results if match == name)
+        suggested = sum(1 for name, (match, suggestions) in results if match is None and name in suggestions)
+        wrong = sum(1 for name, (match, _) in results if match is not None and match != name)
+
+        print(f"{label:<12} {old_time * 1e6:>8.2f} {old_ok * 100 / lookups:>6.1f}% {new_time * 1e6:>8.2f} {new_ok * 100 / lookups:>6.1f}% {suggested * 100 / lookups:>8.1f}%"
+              + (f"  ({wrong} wrong)" if wrong else ""))
+
+    region_index = bot_main.build_place_index(list(ADDRESS))
+    for text in ('Toshkent', 'тошкент вилояти', 'Samarkand', "farg'ona", 'Buhoro'):
+        print(f"region {text!r}: {bot_main.match_place(region_index, text)}")
+
+if __name__ == '__main__':
+    main()
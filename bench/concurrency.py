@@ -0,0 +1,81 @@
+# Concurrency stress test: many threads updating tanga balances through the
+# striped user locks versus one global lock, checking for lost updates.
+# HOLD_TIME simulates work done while the record is locked (e.g. a network
+# call releasing the GIL), which is where striping pays off.
+#
+#   python bench/concurrency.py [threads] [updates_per_thread] [hold_seconds] [fsync_policy]
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+def run(label, threads, updates, update):
+    barrier = threading.Barrier(threads + 1)
+
+    def worker(seed):
+        rng = random.Random(seed)
+        barrier.wait()
+        for _ in range(updates):
+            update(str(rng.randrange(1000)))
+
+    workers = [threading.Thread(target=worker, args=(idx,)) for idx in range(threads)]
+    for thread in workers:
+        thread.start()
+    barrier.wait()
+    started = time.perf_counter()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    print(f"{label:<28} {threads * updates / elapsed:10.0f} updates/s", end=' ')
+
+def main():
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    updates = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    hold = float(sys.argv[3]) if len(sys.argv) > 3 else 0.0001
+    os.chdir(tempfile.mkdtemp())
+    os.environ.setdefault('API_TOKEN', '0:bench')
+    # The default policy fsyncs every posting, which is what production pays
+    if len(sys.argv) > 4:
+        os.environ['FSYNC_POLICY'] = sys.argv[4]
+    import main as bot_main
+    print(f"FSYNC_POLICY={bot_main.FSYNC_POLICY}")
+
+    def reset():
+        for idx in range(1000):
+            bot_main.users[str(idx)] = {'user_id': str(idx), 'tests': {}, 'tanga': 0}
+            bot_main.tanga_balances[str(idx)] = 0
+
+    def check():
+        total = sum(bot_main.users[str(idx)]['tanga'] for idx in range(1000))
+        print(f"lost updates: {threads * updates - total}")
+
+    global_lock = threading.Lock()
+
+    def global_update(user_id):
+        with global_lock:
+            bot_main.users[user_id]['tanga'] += 1
+            time.sleep(hold)
+
+    def striped_update(user_id):
+        with bot_main.user_lock(user_id):
+            time.sleep(hold)
+        # post_tanga takes the user's lock itself and fsyncs after releasing it
+        bot_main.post_tanga(user_id, 1, 'grant')
+
+    def unlocked_update(user_id):
+        balance = bot_main.users[user_id]['tanga']
+        time.sleep(hold)
+        bot_main.users[user_id]['tanga'] = balance + 1
+
+    for label, update in (("no lock", unlocked_update), ("single global lock", global_update), ("striped user locks", striped_update)):
+        reset()
+        run(label, threads, updates, update)
+        check()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+# A local stand-in for the Telegram Bot API, enough to drive main.py under
+# load: getUpdates (long polling), sendMessage, getChatMember and the few
+# other methods the bot calls. Point telebot at it with
+#
+#   telebot.apihelper.API_URL = server.api_url
+#
+# Every outgoing call is recorded so virtual users can wait for the bot's
+# replies and the load test can count messages, bytes and 429s.
+import json
+import threading
+import time
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+class FakeBotAPI:
+    def __init__(self, latency=0.0, chat_rate_limit=None, global_rate_limit=None, retry_after=1, member_status='member'):
+        self.latency = latency
+        self.chat_rate_limit = chat_rate_limit
+        self.global_rate_limit = global_rate_limit
+        self.retry_after = retry_after
+        self.member_status = member_status
+
+        self.lock = threading.Condition()
+        self.updates = []
+        self.next_update_id = 1
+        self.next_message_id = 1
+        self.outbox = defaultdict(list)
+        self.sent_times = defaultdict(deque)
+        self.global_times = deque()
+        self.calls = defaultdict(int)
+        self.bytes_out = 0
+        self.bytes_by_method = defaultdict(int)
+        self.uploads = 0
+        self.rate_limited = 0
+
+        server = self
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                server.handle(self)
+
+            do_POST = do_GET
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def api_url(self):
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}/bot{{0}}/{{1}}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        with self.lock:
+            self.lock.notify_all()
+        self.httpd.shutdown()
+
+    # Virtual users push updates here
+    def push_update(self, chat_id, text=None, callback_data=None, message_id=None, photo=None, message_kind='text'):
+        with self.lock:
+            user = {'id': chat_id, 'is_bot': False, 'first_name': f"User{chat_id}"}
+            chat = {'id': chat_id, 'type': 'private'}
+            update = {'update_id': self.next_update_id}
+            self.next_update_id += 1
+            if callback_data is not None:
+                # The message the button sits on, as far as the bot looks at it
+                message = {'message_id': message_id or 0, 'date': int(time.time()), 'chat': chat}
+                if message_kind == 'photo':
+                    message['photo'] = [{'file_id': 'cached', 'file_unique_id': 'cached', 'width': 640, 'height': 480}]
+                elif message_kind == 'document':
+                    message['document'] = {'file_id': 'cached', 'file_unique_id': 'cached'}
+                else:
+                    message['text'] = ''
+                update['callback_query'] = {
+                    'id': str(update['update_id']), 'from': user, 'chat_instance': str(chat_id), 'data': callback_data, 'message': message,
+                }
+            else:
+                message = {'message_id': self.next_message_id, 'date': int(time.time()), 'chat': chat, 'from': user}
+                self.next_message_id += 1
+                if photo is not None:
+                    message['photo'] = [{'file_id': photo, 'file_unique_id': photo, 'width': 640, 'height': 480}]
+                    message['caption'] = text
+                else:
+                    message['text'] = text
+                    if text and text.startswith('/'):
+                        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+                update['message'] = message
+            self.updates.append(update)
+            self.lock.notify_all()
+            return update['update_id']
+
+    def outgoing_count(self, chat_id):
+        with self.lock:
+            return len(self.outbox[chat_id])
+
+    def wait_for_reply(self, chat_id, seen, timeout=10, ignore=None):
+        # Blocks until the bot has sent chat_id something past index `seen`
+        # that `ignore` does not filter out (e.g. another admin's broadcast)
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            while True:
+                replies = [call for call in self.outbox[chat_id][seen:] if not (ignore and ignore(call))]
+                if replies:
+                    return replies
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.lock.wait(remaining)
+
+    def handle(self, request):
+        path = urlparse(request.path)
+        method = path.path.rsplit('/', 1)[-1]
+        params = dict(parse_qsl(path.query))
+        length = int(request.headers.get('Content-Length') or 0)
+        body = request.rfile.read(length) if length else b''
+        if body and request.headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+            params.update(parse_qsl(body.decode()))
+        elif body:
+            # Multipart upload: remember the size, the name is all we need
+            params['_upload_bytes'] = len(body)
+
+        if method != 'getUpdates' and self.latency:
+            time.sleep(self.latency)
+        status, payload = self.dispatch(method, params)
+        data = json.dumps(payload).encode()
+        request.send_response(status)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
+
+    def throttled(self, chat_id):
+        now = time.monotonic()
+        with self.lock:
+            for times, limit in ((self.sent_times[chat_id], self.chat_rate_limit), (self.global_times, self.global_rate_limit)):
+                if limit is None:
+                    continue
+                while times and now - times[0] > 1:
+                    times.popleft()
+                if len(times) >= limit:
+                    self.rate_limited += 1
+                    return True
+            self.sent_times[chat_id].append(now)
+            self.global_times.append(now)
+        return False
+
+    def dispatch(self, method, params):
+        with self.lock:
+            self.calls[method] += 1
+        if method == 'getUpdates':
+            return 200, {'ok': True, 'result': self.get_updates(params)}
+        if method == 'getMe':
+            return 200, {'ok': True, 'result': {'id': 1, 'is_bot': True, 'first_name': 'QuizBot', 'username': 'quiz_bot'}}
+        if method == 'getChatMember':
+            user = {'id': int(params.get('user_id', 0)), 'is_bot': False, 'first_name': 'User'}
+            return 200, {'ok': True, 'result': {'user': user, 'status': self.member_status}}
+        if method in ('answerCallbackQuery', 'deleteMessage', 'deleteWebhook'):
+            return 200, {'ok': True, 'result': True}
+
+        chat_id = int(params.get('chat_id', 0))
+        if self.throttled(chat_id):
+            return 429, {
+                'ok': False, 'error_code': 429,
+                'description': f"Too Many Requests: retry after {self.retry_after}",
+                'parameters': {'retry_after': self.retry_after},
+            }
+        with self.lock:
+            message_id = int(params['message_id']) if method.startswith('edit') and 'message_id' in params else self.next_message_id
+            if not method.startswith('edit'):
+                self.next_message_id += 1
+            size = (len(params.get('text', '') or params.get('caption', '')) + len(params.get('reply_markup', ''))
+                    + len(params.get('photo', '') or params.get('document', '')) + params.get('_upload_bytes', 0))
+            self.bytes_out += size
+            self.bytes_by_method[method] += size
+            if params.get('_upload_bytes'):
+                self.uploads += 1
+            self.outbox[chat_id].append({'method': method, 'time': time.monotonic(), 'bytes': size, 'message_id': message_id, **params})
+            self.lock.notify_all()
+        message = {'message_id': message_id, 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'private'}}
+        if 'text' in params:
+            message['text'] = params['text']
+        if method in ('sendPhoto', 'sendDocument', 'editMessageMedia'):
+            # A fresh upload gets a new file_id, a resent one keeps it
+            file_id = params.get('photo') or params.get('document') or f"file{message_id}"
+            if params.get('_upload_bytes'):
+                file_id = f"file{message_id}"
+            kind = 'photo' if method != 'sendDocument' else 'document'
+            if kind == 'photo':
+                message['photo'] = [{'file_id': file_id, 'file_unique_id': file_id, 'width': 640, 'height': 480}]
+            else:
+                message['document'] = {'file_id': file_id, 'file_unique_id': file_id}
+            message['caption'] = params.get('caption', '')
+        return 200, {'ok': True, 'result': message}
+
+    def get_updates(self, params):
+        offset = int(params.get('offset', 0))
+        timeout = float(params.get('timeout', 0))
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            # Confirm everything below the offset, like Telegram does
+            self.updates = [update for update in self.updates if update['update_id'] >= offset]
+            while not self.updates:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+                self.lock.wait(remaining)
+                self.updates = [update for update in self.updates if update['update_id'] >= offset]
+            return self.updates[:100]
@@ -0,0 +1,196 @@
+# Load test: runs main.py's bot against the fake Bot API with scripted
+# virtual students (register, take a test, view rankings) and admins (upload
+# a test, broadcast), then reports handler latency percentiles, throughput,
+# outgoing traffic and storage I/O.
+#
+#   python bench/load_test.py --students 50 --admins 1 --questions 10
+import argparse
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import json
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fake_api import FakeBotAPI
+
+ADMIN_ID = 1
+BROADCAST_PREFIX = "E'lon"
+ADDRESS = {'Toshkent': ['Chilonzor tuman', 'Yunusobod tuman'], 'Samarqand': ['Urgut tuman']}
+
+class VirtualUser:
+    def __init__(self, api, chat_id, think_time, latencies, failures):
+        self.api = api
+        self.chat_id = chat_id
+        self.think_time = think_time
+        self.latencies = latencies
+        self.failures = failures
+
+    def say(self, step, text, **kwargs):
+        seen = self.api.outgoing_count(self.chat_id)
+        sent_at = time.monotonic()
+        self.api.push_update(self.chat_id, text, **kwargs)
+        replies = self.api.wait_for_reply(self.chat_id, seen, ignore=lambda call: call.get('text', '').startswith(BROADCAST_PREFIX))
+        if replies is None:
+            self.failures[step] += 1
+            return None
+        self.latencies[step].append(replies[0]['time'] - sent_at)
+        # Give the handler time to register its next step after replying
+        time.sleep(self.think_time * random.uniform(0.5, 1.5))
+        return replies
+
+class Student(VirtualUser):
+    def run(self, test_id, questions):
+        self.say('register', '/start')
+        for step, text in (('register', f"Student {self.chat_id}"), ('register', '12'), ('register', '+998901234567'),
+                           ('register', '9'), ('register', 'Toshkent'), ('register', 'Chilonzor tuman')):
+            self.say(step, text)
+        self.say('start_test', '📄 Test boshlash')
+        replies = self.say('start_test', test_id)
+        for _ in range(questions):
+            question = next((call for call in reversed(replies or []) if 'inline_keyboard' in call.get('reply_markup', '')), None)
+            if question is None:
+                replies = self.say('answer', random.choice('ABCD'))
+                continue
+            # Inline mode: tap a button on the question message
+            buttons = [button for row in json.loads(question['reply_markup'])['inline_keyboard'] for button in row]
+            kind = {'sendPhoto': 'photo', 'sendDocument': 'document'}.get(question['method'], 'text')
+            if question['method'] == 'editMessageMedia':
+                kind = json.loads(question['media'])['type']
+            replies = self.say('answer', None, callback_data=random.choice(buttons)['callback_data'], message_id=question['message_id'], message_kind=kind)
+        self.say('rankings', '📊 Natijalarni ko\'rish')
+        self.say('rankings', test_id)
+
+class Admin(VirtualUser):
+    def run(self, idx, questions):
+        self.say('admin_menu', '/admin_start')
+        self.say('upload', '📄 Test yuklash')
+        for text in ('9', f"ADMIN{idx}", '2000-01-01 00:00', '2100-01-01 00:00'):
+            self.say('upload', text)
+        for number in range(questions):
+            self.say('upload', f"Savol {number + 1}")
+            self.say('upload', '4')
+            self.say('upload', 'A')
+        self.say('upload', '✅ Yakunlash')
+        self.say('broadcast', '📢 Barchaga xabar yuborish')
+        self.say('broadcast', f"{BROADCAST_PREFIX} {idx}")
+
+def percentile(values, pct):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+def make_test(questions, media=False):
+    test = {
+        'test_id': 'T1', 'start_time': '2000-01-01 00:00', 'end_time': '2100-01-01 00:00',
+        'questions': [{'question': f"Savol {idx + 1}", 'option_count': 4, 'options': [f"{idx}{letter}" for letter in 'abcd'], 'correct_answer': random.choice('ABCD')} for idx in range(questions)],
+    }
+    if media:
+        # file_ids as Telegram returns them for the admin's one-time upload
+        for idx, question in enumerate(test['questions']):
+            question['media'] = {'type': 'photo', 'file_id': f"AgACAgIAAxkBAAIB{idx:04d}"}
+    return test
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--students', type=int, default=50)
+    parser.add_argument('--admins', type=int, default=1)
+    parser.add_argument('--questions', type=int, default=10)
+    parser.add_argument('--channels', type=int, default=1, help="required channels, each costs a getChatMember per check")
+    parser.add_argument('--latency', type=float, default=0.0, help="fake API latency per call, seconds")
+    parser.add_argument('--chat-rate-limit', type=int, default=None, help="messages per second per chat before 429")
+    parser.add_argument('--global-rate-limit', type=int, default=None, help="messages per second overall before 429")
+    parser.add_argument('--think-time', type=float, default=0.3, help="pause after each reply; next-step handlers are registered after the prompt is sent")
+    parser.add_argument('--threads', type=int, default=None, help="telebot worker threads")
+    parser.add_argument('--fsync', default=None, help="override FSYNC_POLICY")
+    parser.add_argument('--media', action='store_true', help="give every question an image sent by cached file_id")
+    parser.add_argument('--inline', action='store_true', help="answer with inline buttons (ANSWER_MODE=inline)")
+    parser.add_argument('--profile', type=float, default=None, metavar='SECONDS', help="profile handlers slower than this and print the /slow report")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    os.chdir(workdir)
+    with open('address.json', 'w') as f:
+        json.dump(ADDRESS, f)
+    with open('channels.json', 'w') as f:
+        json.dump([f"channel{idx}" for idx in range(args.channels)], f)
+    with open('test_data.json', 'w') as f:
+        json.dump({'9': {'T1': make_test(args.questions, args.media)}}, f)
+    os.environ['API_TOKEN'] = '0:loadtest'
+    os.environ['MAIN_ADMIN_ID'] = str(ADMIN_ID)
+    if args.fsync:
+        os.environ['FSYNC_POLICY'] = args.fsync
+    if args.inline:
+        os.environ['ANSWER_MODE'] = 'inline'
+    if args.profile is not None:
+        os.environ['PROFILE_HANDLERS'] = '1'
+        os.environ['PROFILE_THRESHOLD'] = str(args.profile)
+
+    api = FakeBotAPI(latency=args.latency, chat_rate_limit=args.chat_rate_limit, global_rate_limit=args.global_rate_limit).start()
+    import telebot
+    telebot.apihelper.API_URL = api.api_url
+    import main as bot_main
+    logging.getLogger().setLevel(logging.WARNING)
+    telebot.logger.setLevel(logging.ERROR)
+    if args.threads:
+        bot_main.bot.worker_pool = telebot.util.ThreadPool(bot_main.bot, num_threads=args.threads)
+
+    io = {'writes': 0, 'bytes': 0, 'seconds': 0.0}
+    write_atomic = bot_main.write_atomic
+    def counting_write_atomic(filename, payload):
+        started = time.perf_counter()
+        write_atomic(filename, payload)
+        io['writes'] += 1
+        io['bytes'] += len(payload)
+        io['seconds'] += time.perf_counter() - started
+    bot_main.write_atomic = counting_write_atomic
+
+    poller = threading.Thread(target=bot_main.bot.infinity_polling, kwargs={'timeout': 10, 'long_polling_timeout': 1}, daemon=True)
+    poller.start()
+
+    latencies = defaultdict(list)
+    failures = defaultdict(int)
+    workers = []
+    for idx in range(args.students):
+        student = Student(api, 1000 + idx, args.think_time, latencies, failures)
+        workers.append(threading.Thread(target=student.run, args=('T1', args.questions)))
+    for idx in range(args.admins):
+        admin = Admin(api, ADMIN_ID if idx == 0 else 2 + idx, args.think_time, latencies, failures)
+        workers.append(threading.Thread(target=admin.run, args=(idx, max(1, args.questions // 5))))
+    if args.admins > 1:
+        bot_main.change_roles(lambda data: data['admins'].extend([str(2 + idx) for idx in range(1, args.admins)]))
+
+    started = time.monotonic()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.monotonic() - started
+    bot_main.bot.stop_polling()
+    api.stop()
+
+    handled = sum(len(values) for values in latencies.values())
+    print(f"{args.students} students, {args.admins} admins, {args.questions} questions in {elapsed:.1f} s")
+    print(f"{'step':<12} {'count':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'timeouts':>8}")
+    for step in sorted(set(latencies) | set(failures)):
+        values = latencies[step]
+        print(f"{step:<12} {len(values):>6} {percentile(values, 50) * 1000:>8.1f} {percentile(values, 95) * 1000:>8.1f} {percentile(values, 99) * 1000:>8.1f} {failures[step]:>8}")
+    all_values = [value for values in latencies.values() for value in values]
+    print(f"{'all':<12} {handled:>6} {percentile(all_values, 50) * 1000:>8.1f} {percentile(all_values, 95) * 1000:>8.1f} {percentile(all_values, 99) * 1000:>8.1f} {sum(failures.values()):>8}")
+    print(f"throughput: {handled / elapsed:.1f} handled updates/s")
+    print(f"api calls: {dict(api.calls)}; 429 responses: {api.rate_limited}")
+    print(f"outgoing bytes: {api.bytes_out} {dict(api.bytes_by_method)}; file uploads: {api.uploads}")
+    print(f"storage: {io['writes']} atomic writes, {io['bytes'] / 1e6:.2f} MB, {io['seconds']:.2f} s in write_atomic")
+    if args.profile is not None:
+        print(f"slow handlers (>= {args.profile * 1000:.0f} ms):")
+        print(bot_main.slow_handler_report() or "none")
+
+if __name__ == '__main__':
+    main()
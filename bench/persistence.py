@@ -0,0 +1,46 @@
+# Persistence benchmark: an in-place dump versus save_json with atomic rename,
+# checksums and rolling backups, per fsync policy. Both write the same compact
+# JSON, so the difference is the cost of the safety, not of the formatting.
+#
+#   python bench/persistence.py [user_count] [saves]
+import json
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from startup import make_users
+
+def measure(label, saves, func):
+    started = time.perf_counter()
+    for _ in range(saves):
+        func()
+    elapsed = time.perf_counter() - started
+    print(f"{label:<36} {elapsed / saves * 1000:9.1f} ms/save {saves / elapsed:8.1f} saves/s")
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    saves = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    workdir = tempfile.mkdtemp()
+    os.chdir(workdir)
+    os.environ.setdefault('API_TOKEN', '0:bench')
+    import main as bot_main
+
+    users = make_users(count)
+    filename = os.path.join(workdir, 'user.json')
+
+    def dump_in_place():
+        with open(filename, 'w') as f:
+            f.write(json.dumps(users, separators=(',', ':')))
+    measure("in-place write", saves, dump_in_place)
+
+    lazy_users = bot_main.LazyUsers(hydrated=users)
+    for policy in ('never', 'data', 'always'):
+        bot_main.FSYNC_POLICY = policy
+        measure(f"save_json fsync={policy}", saves, lambda: bot_main.save_json(filename, lazy_users))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+# Pool sampling benchmark: drawing a test from a large tagged question pool
+# with the cached alias table versus rebuilding the weights and calling
+# random.choices for every attempt, and the size of what an attempt stores.
+#
+#   python bench/pool_sampling.py [pool_size] [sample] [attempts]
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+TOPICS = ['algebra', 'geometriya', 'sonlar', 'funksiyalar', 'ehtimollar']
+LEVELS = ['oson', "o'rta", 'qiyin']
+
+def make_pool(size):
+    return [
+        {
+            'question': f"Savol {idx + 1}: " + "x" * 120, 'options': ['1', '2', '3', '4'], 'option_count': 4,
+            'correct_answer': random.choice('ABCD'), 'topic': TOPICS[idx % len(TOPICS)], 'difficulty': LEVELS[idx % len(LEVELS)],
+        }
+        for idx in range(size)
+    ]
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    sample = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+    attempts = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+    os.chdir(tempfile.mkdtemp())
+    os.environ.setdefault('API_TOKEN', '0:bench')
+    import main as bot_main
+
+    pool = make_pool(size)
+    bot_main.pools['9'] = {'bench': pool}
+    test_data = {'pool': 'bench', 'sample': sample, 'weights': {'difficulty:qiyin': 3, 'topic:ehtimollar': 0}}
+
+    started = time.perf_counter()
+    bot_main.pool_alias_table(9, 'bench', test_data['weights'])
+    print(f"pool of {size}: alias table built in {(time.perf_counter() - started) * 1000:.1f} ms (once per pool and weights)")
+
+    started = time.perf_counter()
+    for _ in range(attempts):
+        chosen = bot_main.sample_pool_questions(9, test_data)
+    alias_time = (time.perf_counter() - started) / attempts
+    print(f"alias table sampling: {alias_time * 1e6:10.1f} us per attempt")
+
+    started = time.perf_counter()
+    for _ in range(max(1, attempts // 100)):
+        # What each attempt costs without the index and the cached table
+        weights = [
+            (3 if question['difficulty'] == 'qiyin' else 1) * (0 if question['topic'] == 'ehtimollar' else 1)
+            for question in pool
+        ]
+        drawn = set()
+        while len(drawn) < sample:
+            drawn.update(random.choices(range(size), weights, k=sample - len(drawn)))
+    naive_time = (time.perf_counter() - started) / max(1, attempts // 100)
+    print(f"weights + random.choices: {naive_time * 1e6:10.1f} us per attempt")
+
+    stored = len(json.dumps({'answers': ['A'] * sample, 'questions': chosen}))
+    copied = len(json.dumps({'answers': ['A'] * sample, 'questions': [pool[idx] for idx in chosen]}))
+    print(f"attempt record: {stored} bytes with pool indices, {copied} bytes with copied questions")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+# Startup benchmark: parse time of the old indent=4 user.json versus the
+# marshal snapshot written next to it, at 100k users by default.
+#
+#   python bench/startup.py [user_count]
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+def make_users(count):
+    users = {}
+    for idx in range(count):
+        users[str(100000000 + idx)] = {
+            'user_id': str(idx + 1).zfill(5),
+            'tests': {
+                f"test{t}": {'answers': [random.choice('ABCD') for _ in range(30)], 'score': random.randint(0, 30), 'finished': True}
+                for t in range(5)
+            },
+            'tanga': random.randint(0, 500),
+            'name': f"User {idx}",
+            'age': random.randint(7, 25),
+            'phone': '+998901234567',
+            'class': random.randint(1, 12),
+            'region': 'Toshkent',
+            'district': 'Chilonzor tuman',
+        }
+    return users
+
+def timed(label, func):
+    started = time.perf_counter()
+    result = func()
+    print(f"{label:<40} {time.perf_counter() - started:8.3f} s")
+    return result
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    workdir = tempfile.mkdtemp()
+    os.chdir(workdir)
+    os.environ.setdefault('API_TOKEN', '0:bench')
+    import main as bot_main
+
+    users = make_users(count)
+    filename = os.path.join(workdir, 'user.json')
+    with open(filename, 'w') as f:
+        json.dump(users, f, indent=4)
+    print(f"{count} users, indent=4 user.json: {os.path.getsize(filename) / 1e6:.1f} MB")
+
+    def load_indented():
+        with open(filename) as f:
+            return json.load(f)
+    timed("json.load (indent=4)", load_indented)
+
+    lazy_users, bot_main.last_user_id = timed("load_users (no snapshot)", lambda: bot_main.load_users(filename))
+    timed("save_users (json + snapshot)", lambda: bot_main.save_users(filename, lazy_users, snapshot=True))
+    print(f"compact user.json: {os.path.getsize(filename) / 1e6:.1f} MB, snapshot: {os.path.getsize(bot_main.snapshot_filename(filename)) / 1e6:.1f} MB")
+
+    lazy_users, _ = timed("load_users (snapshot)", lambda: bot_main.load_users(filename))
+    sample = random.sample(list(lazy_users), 1000)
+    timed("hydrate 1000 users", lambda: [lazy_users[user_id] for user_id in sample])
+    timed("save_users after 1000 hydrated", lambda: bot_main.save_users(filename, lazy_users))
+
+if __name__ == '__main__':
+    main()
@@ -1,56 +1,879 @@
 import telebot
 from telebot import types
+from telebot.handler_backends import FileHandlerBackend
 import datetime
+import gzip
+import hashlib
+import heapq
+import io
 import json
 import os
 import logging
+import marshal
+import random
 import re
+import shutil
+import signal
+import sys
+import threading
+import time
+import unicodedata
+from collections import Counter, deque, namedtuple
+from functools import lru_cache, wraps
+from collections.abc import MutableMapping
+from types import MappingProxyType
+from urllib.parse import quote
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
 load_dotenv()
-API_TOKEN = os.getenv('API_TOKEN')
-MAIN_ADMIN_ID = os.getenv('MAIN_ADMIN_ID')
+# tenants.py executes this module once per bot, injecting TENANT_CONFIG (token,
+# main admin, data directory) and SHARED_CACHE (data built once for every
+# tenant, and the one profiler sampler they share) before it runs. Run directly, both are empty and the environment
+# and working directory apply.
+TENANT_CONFIG = globals().get('TENANT_CONFIG', {})
+SHARED_CACHE = globals().get('SHARED_CACHE', {})
+API_TOKEN = TENANT_CONFIG.get('token', os.getenv('API_TOKEN'))
+MAIN_ADMIN_ID = TENANT_CONFIG.get('main_admin_id', os.getenv('MAIN_ADMIN_ID'))
+DATA_DIR = os.path.abspath(TENANT_CONFIG.get('data_dir', os.getenv('DATA_DIR', '.')))
+# always: fsync file and directory, data: fsync file only, never: leave it to the OS
+FSYNC_POLICY = os.getenv('FSYNC_POLICY', 'always')
+BACKUP_COUNT = int(os.getenv('BACKUP_COUNT', '5'))
+BACKUP_INTERVAL = int(os.getenv('BACKUP_INTERVAL', '300'))
+# The marshal snapshot of user.json is refreshed at most this often (and at shutdown)
+SNAPSHOT_INTERVAL = int(os.getenv('SNAPSHOT_INTERVAL', '300'))
+LEDGER_COMPACT_EVERY = int(os.getenv('LEDGER_COMPACT_EVERY', '10000'))
+# Answers of tests closed for ARCHIVE_AFTER seconds move to archive/ on a
+# background pass every ARCHIVE_INTERVAL seconds
+ARCHIVE_AFTER = int(os.getenv('ARCHIVE_AFTER', '86400'))
+ARCHIVE_INTERVAL = int(os.getenv('ARCHIVE_INTERVAL', '3600'))
+# Long-poll length bounds how long a stop request waits for getUpdates;
+# SHUTDOWN_TIMEOUT bounds how long running handlers get to finish
+POLL_TIMEOUT = int(os.getenv('POLL_TIMEOUT', '10'))
+SHUTDOWN_TIMEOUT = float(os.getenv('SHUTDOWN_TIMEOUT', '25'))
+# reply: one message and next-step handler per question; inline: answer
+# buttons on a single message that is edited in place
+ANSWER_MODE = os.getenv('ANSWER_MODE', 'reply')
+# Each student gets the questions (and listed options) in their own order
+SHUFFLE_QUESTIONS = os.getenv('SHUFFLE_QUESTIONS', '1') == '1'
+ATTEMPT_ORDER_CACHE = int(os.getenv('ATTEMPT_ORDER_CACHE', '10000'))
+# Handler timing and sampling profiler, off unless PROFILE_HANDLERS=1.
+# Handlers slower than PROFILE_THRESHOLD seconds keep their profile.
+PROFILE_HANDLERS = os.getenv('PROFILE_HANDLERS', '0') == '1'
+PROFILE_THRESHOLD = float(os.getenv('PROFILE_THRESHOLD', '0.5'))
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', '0.005'))
 
 # Logging configuration
 logging.basicConfig(level=logging.DEBUG)
 
-bot = telebot.TeleBot(API_TOKEN)
-
-admins = {MAIN_ADMIN_ID}
+# While a profiled handler runs, its thread is in profiled_threads and the
+# sampler thread counts the functions on its stack every PROFILE_INTERVAL.
+# Profiles only change under profile_lock, so once a handler has taken its
+# profile out of profiled_threads nothing touches it again. Tenants share
+# one sampler and profiled_threads; timings and slow handlers are per bot.
+profiled_threads = SHARED_CACHE.setdefault('profiled_threads', {})
+profile_lock = SHARED_CACHE.setdefault('profile_lock', threading.Lock())
+sampler_started = SHARED_CACHE.setdefault('sampler_started', threading.Event())
+handler_timings = {}
+slow_handlers = deque(maxlen=200)
+
+def frame_key(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def sample_stacks():
+    while True:
+        time.sleep(PROFILE_INTERVAL)
+        with profile_lock:
+            if not profiled_threads:
+                continue
+            frames = sys._current_frames()
+            for thread_id, profile in profiled_threads.items():
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                profile['samples'] += 1
+                profile['self'][frame_key(frame)] += 1
+                seen = set()
+                while frame is not None:
+                    key = frame_key(frame)
+                    # Recursion counts once per sample
+                    if key not in seen:
+                        seen.add(key)
+                        profile['total'][key] += 1
+                    frame = frame.f_back
+
+def profiled(handler):
+    if not PROFILE_HANDLERS:
+        return handler
+    name = getattr(handler, '__name__', repr(handler))
+
+    @wraps(handler)
+    def wrapper(*args, **kwargs):
+        if not sampler_started.is_set():
+            with profile_lock:
+                if not sampler_started.is_set():
+                    threading.Thread(target=sample_stacks, daemon=True).start()
+                    sampler_started.set()
+        thread_id = threading.get_ident()
+        profile = {'samples': 0, 'self': Counter(), 'total': Counter()}
+        with profile_lock:
+            profiled_threads[thread_id] = profile
+        started = time.perf_counter()
+        try:
+            return handler(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            with profile_lock:
+                profiled_threads.pop(thread_id, None)
+                timing = handler_timings.setdefault(name, [0, 0.0, 0.0])
+                timing[0] += 1
+                timing[1] += elapsed
+                timing[2] = max(timing[2], elapsed)
+                if elapsed >= PROFILE_THRESHOLD:
+                    slow_handlers.append({'handler': name, 'elapsed': elapsed, 'time': time.time(), **profile})
+    return wrapper
+
+def slow_handler_report(limit=10, functions=5):
+    with profile_lock:
+        captured = list(slow_handlers)
+        timings = {name: list(timing) for name, timing in handler_timings.items()}
+    grouped = {}
+    for capture in captured:
+        group = grouped.setdefault(capture['handler'], {'count': 0, 'max': 0.0, 'samples': 0, 'total': Counter(), 'self': Counter()})
+        group['count'] += 1
+        group['max'] = max(group['max'], capture['elapsed'])
+        group['samples'] += capture['samples']
+        group['total'].update(capture['total'])
+        group['self'].update(capture['self'])
+    lines = []
+    for name, group in sorted(grouped.items(), key=lambda x: x[1]['max'], reverse=True)[:limit]:
+        count, total, _ = timings.get(name, [group['count'], 0.0, 0.0])
+        lines.append(f"{name}: {group['count']} ta sekin, eng uzuni {group['max'] * 1000:.0f} ms, o'rtacha {total / max(count, 1) * 1000:.0f} ms ({count} chaqiruv)")
+        samples = max(group['samples'], 1)
+        for key, hits in group['self'].most_common(functions):
+            lines.append(f"    {hits * 100 // samples}% o'zi - {key}")
+        # Which of the bot's own functions the time was spent under
+        own = [(key, hits) for key, hits in group['total'].most_common()
+               if f"({os.path.basename(__file__)}:" in key and not key.startswith((f"{name} ", 'wrapper ', 'sample_stacks '))]
+        for key, hits in own[:functions]:
+            lines.append(f"    {hits * 100 // samples}% jami - {key}")
+    return "\n".join(lines)
+
+class QuizBot(telebot.TeleBot):
+    # telebot pops handled messages from the batch while enumerating it, so
+    # when two chats' replies arrive in one getUpdates batch the second one
+    # skips its next-step handler and is dropped.
+    def _notify_next_handlers(self, new_messages):
+        remaining = []
+        for message in new_messages:
+            handlers = self.next_step_backend.get_handlers(message.chat.id)
+            if not handlers:
+                remaining.append(message)
+                continue
+            for handler in handlers:
+                self._exec_task(profiled(handler["callback"]), message, *handler["args"], **handler["kwargs"])
+        new_messages[:] = remaining
+
+    # Every registered handler goes through the timing decorator; with
+    # profiling off it hands the function back unchanged
+    def message_handler(self, *args, **kwargs):
+        register = super().message_handler(*args, **kwargs)
+        return lambda handler: register(profiled(handler))
+
+    def callback_query_handler(self, *args, **kwargs):
+        register = super().callback_query_handler(*args, **kwargs)
+        return lambda handler: register(profiled(handler))
+
+# Tenants share one worker pool in tenants.py, so their bots run handlers on
+# the thread that hands them updates
+bot = QuizBot(API_TOKEN, threaded=TENANT_CONFIG.get('threaded', True))
+
+# Every data file lives under DATA_DIR. DATA_DIR is absolute, so resolving
+# an already resolved path is a no-op.
+def data_path(filename):
+    return os.path.join(DATA_DIR, filename)
+
+os.makedirs(DATA_DIR, exist_ok=True)
+
+# Serializes writers across telebot's worker threads
+save_lock = threading.RLock()
+last_backup = {}
+
+def checksum(payload):
+    return hashlib.sha256(payload).hexdigest()
+
+def read_checksums(filename):
+    try:
+        with open(filename + '.sha256', 'r') as f:
+            return f.read().split()
+    except FileNotFoundError:
+        return None
+
+def backup_filename(filename, idx):
+    return os.path.join(os.path.dirname(filename), 'backups', f"{os.path.basename(filename)}.{idx}")
+
+def write_atomic(filename, payload):
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(payload)
+        if FSYNC_POLICY != 'never':
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp, filename)
+    if FSYNC_POLICY == 'always':
+        try:
+            fd = os.open(os.path.dirname(os.path.abspath(filename)), os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        except OSError:
+            pass
+
+def write_file(filename, payload):
+    with save_lock:
+        digest = checksum(payload)
+        # The sidecar keeps the previous checksum too, so a crash between the
+        # two renames still leaves a file that verifies.
+        previous = (read_checksums(filename) or [''])[0]
+        write_atomic(filename + '.sha256', f"{digest}\n{previous}\n".encode())
+        write_atomic(filename, payload)
+        rotate_backups(filename, digest)
+        return digest
+
+def rotate_backups(filename, digest):
+    now = time.time()
+    if BACKUP_COUNT <= 0 or now - last_backup.get(filename, 0) < BACKUP_INTERVAL:
+        return
+    last_backup[filename] = now
+    os.makedirs(os.path.dirname(backup_filename(filename, 1)), exist_ok=True)
+    for idx in range(BACKUP_COUNT - 1, 0, -1):
+        for suffix in ('', '.sha256'):
+            if os.path.exists(backup_filename(filename, idx) + suffix):
+                os.replace(backup_filename(filename, idx) + suffix, backup_filename(filename, idx + 1) + suffix)
+    shutil.copyfile(filename, backup_filename(filename, 1))
+    with open(backup_filename(filename, 1) + '.sha256', 'w') as f:
+        f.write(digest)
+
+def read_verified(filename):
+    with open(filename, 'rb') as f:
+        payload = f.read()
+    checksums = read_checksums(filename)
+    if checksums is not None and checksum(payload) not in checksums:
+        raise ValueError(f"checksum mismatch in {filename}")
+    return json.loads(payload)
+
+def recover_from_backups(filename):
+    for idx in range(1, BACKUP_COUNT + 1):
+        backup = backup_filename(filename, idx)
+        if not os.path.exists(backup):
+            continue
+        try:
+            data = read_verified(backup)
+        except ValueError as e:
+            logging.error(f"Backup {backup} is not usable: {e}")
+            continue
+        if os.path.exists(filename):
+            os.replace(filename, filename + '.corrupt')
+        with open(backup, 'rb') as f:
+            write_file(filename, f.read())
+        logging.warning(f"{filename} restored from {backup}")
+        return data
+    raise RuntimeError(f"{filename} is corrupted and no valid backup was found")
 
 def load_json(filename):
+    filename = data_path(filename)
     if not os.path.exists(filename):
         return {}
+    # Backups are only for a file that is there but unreadable or fails its checksum
     try:
-        with open(filename, 'r') as f:
-            data = json.load(f)
-            return data
-    except json.JSONDecodeError:
-        return {}
+        return read_verified(filename)
+    except ValueError as e:
+        logging.error(f"Error loading {filename}: {e}")
+        return recover_from_backups(filename)
 
-def save_json(filename, data):
+def save_json(filename, data, snapshot=False):
+    filename = data_path(filename)
     try:
-        with open(filename, 'w') as f:
-            json.dump(data, f, indent=4)
+        with save_lock:
+            if isinstance(data, LazyUsers):
+                save_users(filename, data, snapshot)
+            else:
+                write_file(filename, json.dumps(data, separators=(',', ':')).encode())
         logging.info(f"Data successfully saved to {filename}")
     except Exception as e:
         logging.error(f"Error saving data to {filename}: {e}")
 
+# Users keep their raw JSON text until first accessed, so startup only pays
+# for unmarshalling strings and saving reuses the text of untouched users.
+class LazyUsers(MutableMapping):
+    def __init__(self, raw=None, hydrated=None):
+        self.raw = raw or {}
+        self.hydrated = hydrated or {}
+        self.lock = threading.Lock()
+
+    def __getitem__(self, user_id):
+        try:
+            return self.hydrated[user_id]
+        except KeyError:
+            with self.lock:
+                if user_id not in self.hydrated:
+                    self.hydrated[user_id] = json.loads(self.raw.pop(user_id))
+                return self.hydrated[user_id]
+
+    def __setitem__(self, user_id, user):
+        with self.lock:
+            self.raw.pop(user_id, None)
+            self.hydrated[user_id] = user
+
+    def __delitem__(self, user_id):
+        with self.lock:
+            if self.hydrated.pop(user_id, None) is None:
+                del self.raw[user_id]
+
+    # A user moves from raw to hydrated under self.lock, so anything that
+    # looks at both dicts takes it too, or it could miss a user in between
+    def __contains__(self, user_id):
+        if user_id in self.hydrated:
+            return True
+        with self.lock:
+            return user_id in self.hydrated or user_id in self.raw
+
+    def __iter__(self):
+        with self.lock:
+            user_ids = list(self.hydrated) + list(self.raw)
+        yield from user_ids
+
+    def __len__(self):
+        with self.lock:
+            return len(self.hydrated) + len(self.raw)
+
+    def peek(self, user_id):
+        # A read-only view of the user that leaves a raw user raw
+        with self.lock:
+            if user_id in self.hydrated:
+                return self.hydrated[user_id]
+            text = self.raw.get(user_id)
+        return None if text is None else json.loads(text)
+
+    def scan(self, needles=None):
+        # (user_id, user) for every user without hydrating anyone. Raw users
+        # come back as throwaway copies; with needles, only those whose text
+        # contains one of them are parsed at all.
+        with self.lock:
+            hydrated = list(self.hydrated.items())
+            raw = list(self.raw.items())
+        yield from hydrated
+        for user_id, text in raw:
+            if needles is None or any(needle in text for needle in needles):
+                yield user_id, json.loads(text)
+
+    def ids_mentioning(self, needles):
+        # Hydrated ids plus the raw ids whose text contains one of needles,
+        # without parsing or hydrating anyone
+        with self.lock:
+            return list(self.hydrated) + [user_id for user_id, text in self.raw.items() if any(needle in text for needle in needles)]
+
+    def dump_raw(self):
+        dumped = dict(self.raw)
+        for user_id, user in list(self.hydrated.items()):
+            with user_lock(user_id):
+                dumped[user_id] = json.dumps(user, separators=(',', ':'))
+        return dumped
+
+def snapshot_filename(filename):
+    return filename + '.snap'
+
+# The snapshot is '<sha256>\n' followed by the marshal payload, which records
+# the checksum of the user.json it was taken from. It is only used while that
+# user.json is still the current one.
+last_snapshot = 0
+
+def read_snapshot(snapshot):
+    with open(snapshot, 'rb') as f:
+        digest, _, payload = f.read().partition(b'\n')
+    if checksum(payload) != digest.decode('ascii', 'replace'):
+        raise ValueError("checksum mismatch")
+    return marshal.loads(payload)
+
+def load_users(filename):
+    filename = data_path(filename)
+    snapshot = snapshot_filename(filename)
+    checksums = read_checksums(filename)
+    if os.path.exists(snapshot) and checksums:
+        try:
+            data = read_snapshot(snapshot)
+            if data['source'] == checksums[0]:
+                return LazyUsers(raw=data['users']), data['last_user_id']
+            logging.info(f"Snapshot {snapshot} is older than {filename}, loading {filename}")
+        except (EOFError, ValueError, TypeError, KeyError) as e:
+            logging.error(f"Snapshot {snapshot} is unreadable, falling back to {filename}: {e}")
+    data = load_json(filename)
+    last_user_id = max([int(user['user_id']) for user in data.values()] or [0])
+    return LazyUsers(hydrated=data), last_user_id
+
+def save_users(filename, data, snapshot=False):
+    global last_snapshot
+    dumped = data.dump_raw()
+    digest = write_file(filename, ('{' + ','.join([f"{json.dumps(user_id)}:{raw}" for user_id, raw in dumped.items()]) + '}').encode())
+    # The snapshot only speeds up the next start, so it is not rewritten on
+    # every save
+    now = time.time()
+    if snapshot or now - last_snapshot >= SNAPSHOT_INTERVAL:
+        last_snapshot = now
+        payload = marshal.dumps({'users': dumped, 'last_user_id': last_user_id, 'source': digest})
+        write_atomic(snapshot_filename(filename), checksum(payload).encode() + b'\n' + payload)
+
+# Handlers run on telebot's thread pool. A user's record is only mutated while
+# holding its stripe lock; save_json must be called after releasing it, since
+# saving takes the stripe locks one by one under save_lock.
+USER_LOCK_STRIPES = 64
+user_locks = [threading.RLock() for _ in range(USER_LOCK_STRIPES)]
+# Guards test_stats and rollups, always taken after a user lock
+stats_lock = threading.RLock()
+channels_lock = threading.Lock()
+# Guards pools.json and the indexes built from it
+pools_lock = threading.Lock()
+
+def user_lock(user_id):
+    return user_locks[hash(str(user_id)) % USER_LOCK_STRIPES]
+
+class all_user_locks:
+    def __enter__(self):
+        for lock in user_locks:
+            lock.acquire()
+
+    def __exit__(self, *exc):
+        for lock in reversed(user_locks):
+            lock.release()
+
 # Load data from files
 tests = load_json('test_data.json')
-users = load_json('user.json')
-address = load_json('address.json')
+users, last_user_id = load_users('user.json')
+# The address list is the same for every tenant, so it is loaded once
+if 'address' not in SHARED_CACHE:
+    SHARED_CACHE['address'] = load_json('address.json')
+address = SHARED_CACHE['address']
 viloyatlar = list(address.keys())
 required_channels = load_json('channels.json')
+# Question pools per class: {class_id: {pool_name: [question, ...]}}
+pools = load_json('pools.json')
+
+# Region and district names typed by users are matched through an index
+# built once from address.json: case, apostrophe variants, Cyrillic spelling
+# and suffixes like "tuman" are normalized away, and what still does not match
+# exactly is looked up by trigram similarity.
+CYRILLIC_TO_LATIN = str.maketrans({
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'ғ': "g'", 'д': 'd', 'е': 'e', 'ё': 'yo', 'ж': 'j', 'з': 'z',
+    'и': 'i', 'й': 'y', 'к': 'k', 'қ': 'q', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r',
+    'с': 's', 'т': 't', 'у': 'u', 'ў': "o'", 'ф': 'f', 'х': 'x', 'ҳ': 'h', 'ц': 's', 'ч': 'ch', 'ш': 'sh',
+    'щ': 'sh', 'ъ': "'", 'ь': '', 'ы': 'i', 'э': 'e', 'ю': 'yu', 'я': 'ya',
+})
+PLACE_SUFFIXES = {
+    'tuman', 'tumani', 'viloyat', 'viloyati', 'shahar', 'shahri', 'shaxar', 'shaxri',
+    'rayon', 'rayoni', 'oblast', 'oblasti', 'respublikasi', 'region', 'district', 'city',
+}
+# Similarity a fuzzy match needs to be taken without asking, how far ahead
+# of the runner-up it must be, and the floor for offering a suggestion
+PLACE_AUTO_ACCEPT = 0.6
+PLACE_MARGIN = 0.15
+PLACE_SUGGEST = 0.3
+
+def normalize_place(text):
+    text = unicodedata.normalize('NFKC', text or '').lower().translate(CYRILLIC_TO_LATIN)
+    # Every apostrophe variant goes, so o'/oʻ/o` and ғ/ў all collapse
+    text = re.sub(r"['`ʻʼ‘’´]", '', text)
+    words = re.sub(r'[^0-9a-z]+', ' ', text).split()
+    return ' '.join(words), ' '.join([word for word in words if word not in PLACE_SUFFIXES]) or ' '.join(words)
+
+def place_trigrams(key):
+    padded = f"  {key} "
+    return {padded[idx:idx + 3] for idx in range(len(padded) - 2)}
+
+def build_place_index(names):
+    index = {'names': list(names), 'keys': {}, 'trigrams': {}, 'sizes': []}
+    for idx, name in enumerate(index['names']):
+        full, short = normalize_place(name)
+        for key in {full, short}:
+            index['keys'].setdefault(key, []).append(idx)
+        grams = place_trigrams(short)
+        index['sizes'].append(len(grams))
+        for gram in grams:
+            index['trigrams'].setdefault(gram, []).append(idx)
+    return index
+
+def match_place(index, text):
+    # Returns (name, []) for a confident match, else (None, suggestions)
+    names = index['names']
+    if text in names:
+        return text, []
+    full, short = normalize_place(text)
+    for key in (full, short):
+        hits = index['keys'].get(key)
+        if hits and len(hits) == 1:
+            return names[hits[0]], []
+        if hits:
+            # e.g. "Toshkent" for both the city and the region
+            return None, [names[idx] for idx in hits]
+    grams = place_trigrams(short)
+    shared = {}
+    for gram in grams:
+        for idx in index['trigrams'].get(gram, ()):
+            shared[idx] = shared.get(idx, 0) + 1
+    scored = sorted([(2 * count / (len(grams) + index['sizes'][idx]), idx) for idx, count in shared.items()], reverse=True)
+    if scored and scored[0][0] >= PLACE_AUTO_ACCEPT and (len(scored) == 1 or scored[0][0] - scored[1][0] >= PLACE_MARGIN):
+        return names[scored[0][1]], []
+    return None, [names[idx] for score, idx in scored[:3] if score >= PLACE_SUGGEST]
+
+if 'region_index' not in SHARED_CACHE:
+    SHARED_CACHE['region_index'] = build_place_index(viloyatlar)
+    SHARED_CACHE['district_indexes'] = {region: build_place_index(districts) for region, districts in address.items()}
+region_index = SHARED_CACHE['region_index']
+district_indexes = SHARED_CACHE['district_indexes']
+
+def ask_place_again(message, error_text, suggestions):
+    if not suggestions:
+        return bot.send_message(message.chat.id, error_text)
+    markup = types.ReplyKeyboardMarkup(row_width=1)
+    for name in suggestions:
+        markup.add(types.KeyboardButton(name))
+    markup.add(types.KeyboardButton('⬅Ortga'))
+    return bot.send_message(message.chat.id, f"{error_text}\nBalki shulardan birini nazarda tutgandirsiz:", reply_markup=markup)
+
+# Roles live in admins.json. Handlers read the immutable `roles` snapshot
+# without locking; changes build a new snapshot and swap the reference. Other
+# processes sharing the file pick up changes through its mtime.
+ROLES_FILE = data_path('admins.json')
+ROLES_REFRESH_INTERVAL = 2
+Roles = namedtuple('Roles', ['admins', 'authors', 'mtime'])
+roles_lock = threading.Lock()
+roles_checked = 0
+
+def build_roles(data, mtime):
+    admin_ids = [MAIN_ADMIN_ID] + data.get('admins', [])
+    authors = {chat_id: frozenset(classes) for chat_id, classes in data.get('authors', {}).items() if classes}
+    return Roles(frozenset([admin_id for admin_id in admin_ids if admin_id]), MappingProxyType(authors), mtime)
+
+def roles_file_mtime():
+    try:
+        return os.path.getmtime(ROLES_FILE)
+    except OSError:
+        return 0
+
+def load_roles():
+    return build_roles(load_json(ROLES_FILE), roles_file_mtime())
+
+def current_roles():
+    global roles, roles_checked
+    now = time.monotonic()
+    if now - roles_checked > ROLES_REFRESH_INTERVAL:
+        roles_checked = now
+        if roles_file_mtime() != roles.mtime:
+            with roles_lock:
+                roles = load_roles()
+    return roles
+
+def change_roles(change):
+    global roles
+    with roles_lock:
+        data = load_json(ROLES_FILE)
+        data.setdefault('admins', [])
+        data.setdefault('authors', {})
+        result = change(data)
+        save_json(ROLES_FILE, data)
+        roles = build_roles(data, roles_file_mtime())
+    return result
+
+roles = load_roles()
 
 # Check if the user is an admin
 def is_admin(chat_id):
-    return str(chat_id) in admins
+    return str(chat_id) in current_roles().admins
+
+def is_test_author(chat_id, class_id=None):
+    classes = current_roles().authors.get(str(chat_id))
+    if not classes:
+        return False
+    return class_id is None or int(class_id) in classes
+
+# Tanga ledger: every balance change is appended to tanga_ledger.jsonl before
+# it is applied. tanga_balances is the materialized view (mirrored into
+# users[...]['tanga']), ledger_keys makes retried postings no-ops, and
+# compaction folds the log into tanga_checkpoint.json. A balance from before
+# the ledger is carried over by an 'opening' entry on the user's first
+# posting, so nothing reads every user up front.
+LEDGER_FILE = data_path('tanga_ledger.jsonl')
+LEDGER_CHECKPOINT = data_path('tanga_checkpoint.json')
+ledger_lock = threading.Lock()
+compact_lock = threading.Lock()
+# Held while fsyncing the ledger, taken before ledger_lock
+sync_lock = threading.Lock()
+
+def load_ledger():
+    checkpoint = load_json(LEDGER_CHECKPOINT) or {'seq': 0, 'balances': {}, 'keys': {}}
+    balances, seq = checkpoint['balances'], checkpoint['seq']
+    # Keys map to the seq they were posted at; older checkpoints kept a list
+    keys = checkpoint['keys']
+    if not isinstance(keys, dict):
+        keys = dict.fromkeys(keys, checkpoint['seq'])
+    pending = 0
+    if os.path.exists(LEDGER_FILE):
+        with open(LEDGER_FILE, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    logging.error(f"Skipping torn line in {LEDGER_FILE}")
+                    continue
+                if entry['seq'] <= checkpoint['seq']:
+                    continue
+                balances[entry['user']] = balances.get(entry['user'], 0) + entry['amount']
+                if entry['key']:
+                    keys[entry['key']] = entry['seq']
+                seq = max(seq, entry['seq'])
+                pending += 1
+                # user.json may have been saved before this entry was applied
+                if entry['user'] in users:
+                    users[entry['user']]['tanga'] = balances[entry['user']]
+    return balances, keys, seq, checkpoint['seq'], pending
+
+tanga_balances, ledger_keys, ledger_seq, checkpoint_seq, ledger_pending = load_ledger()
+ledger_file = open(LEDGER_FILE, 'a')
+ledger_synced = ledger_seq
+
+def append_ledger(user_id, amount, kind, key):
+    # Called with ledger_lock held
+    global ledger_seq, ledger_pending
+    ledger_seq += 1
+    ledger_file.write(json.dumps({'seq': ledger_seq, 'ts': int(time.time()), 'user': user_id, 'amount': amount, 'kind': kind, 'key': key}) + '\n')
+    if key:
+        ledger_keys[key] = ledger_seq
+    ledger_pending += 1
+
+def sync_ledger(seq):
+    # Group commit: the fsync runs outside ledger_lock, and one fsync covers
+    # every entry written before it, so concurrent postings share it
+    global ledger_synced
+    if FSYNC_POLICY == 'never':
+        return
+    with sync_lock:
+        if ledger_synced >= seq:
+            return
+        with ledger_lock:
+            target = ledger_seq
+        os.fsync(ledger_file.fileno())
+        ledger_synced = target
+
+def post_tanga(user_id, amount, kind, key=None):
+    with user_lock(user_id), ledger_lock:
+        if key and key in ledger_keys:
+            return False
+        if user_id not in tanga_balances:
+            opening = tanga_balances[user_id] = users[user_id].get('tanga', 0)
+            if opening:
+                append_ledger(user_id, opening, 'opening', None)
+        append_ledger(user_id, amount, kind, key)
+        ledger_file.flush()
+        tanga_balances[user_id] += amount
+        users[user_id]['tanga'] = tanga_balances[user_id]
+        track_top_holder(user_id, tanga_balances[user_id])
+        rollup_tanga(users[user_id], amount)
+        seq = ledger_seq
+    sync_ledger(seq)
+    if ledger_pending >= LEDGER_COMPACT_EVERY:
+        compact_ledger()
+    return True
+
+# Top coin holders: the TOP_HOLDERS_KEPT largest positive balances, and
+# top_floor, which no balance outside them exceeds. Postings keep both up to
+# date under ledger_lock. Every balance is only read to build them on first
+# use, or again once falling balances leave fewer certain places than asked.
+TOP_HOLDERS_KEPT = 50
+top_holders = None
+top_floor = 0
+
+def track_top_holder(user_id, balance):
+    # Called with ledger_lock held
+    global top_floor
+    if top_holders is None:
+        return
+    if user_id in top_holders or balance > top_floor:
+        top_holders[user_id] = balance
+        if len(top_holders) > TOP_HOLDERS_KEPT:
+            lowest = min(top_holders, key=top_holders.get)
+            top_floor = max(top_floor, top_holders.pop(lowest))
+
+def rebuild_top_holders():
+    global top_holders, top_floor
+    # Users without a posting yet still hold the balance they had before the
+    # ledger; anyone posted to meanwhile is taken from tanga_balances below
+    opening = {user_id: user['tanga'] for user_id, user in users.scan() if user.get('tanga', 0) > 0}
+    with ledger_lock:
+        balances = {**opening, **tanga_balances}
+        ranked = heapq.nlargest(TOP_HOLDERS_KEPT + 1, [(user_id, balance) for user_id, balance in balances.items() if balance > 0], key=lambda x: x[1])
+        top_holders = dict(ranked[:TOP_HOLDERS_KEPT])
+        top_floor = ranked[TOP_HOLDERS_KEPT][1] if len(ranked) > TOP_HOLDERS_KEPT else 0
+
+def certain_top_holders(limit):
+    # Called with ledger_lock held; None when the list has to be rebuilt
+    if top_holders is None:
+        return None
+    ranked = [(user_id, balance) for user_id, balance in top_holders.items() if balance > 0 and balance >= top_floor]
+    return ranked if len(ranked) >= limit or top_floor == 0 else None
+
+def get_top_holders(limit=10):
+    with ledger_lock:
+        ranked = certain_top_holders(limit)
+    if ranked is None:
+        rebuild_top_holders()
+        with ledger_lock:
+            # Whatever is certain now, even if a posting lowered it meanwhile
+            ranked = certain_top_holders(0)
+    return heapq.nlargest(limit, ranked, key=lambda x: x[1])
+
+def tanga_balance(user_id):
+    with ledger_lock:
+        if user_id in tanga_balances:
+            return tanga_balances[user_id]
+    user = users.peek(user_id)
+    return user.get('tanga', 0) if user else 0
+
+def compact_ledger():
+    global ledger_file, ledger_pending, ledger_keys, checkpoint_seq, ledger_synced
+    if not compact_lock.acquire(blocking=False):
+        return
+    try:
+        with ledger_lock:
+            # Keys from before the previous checkpoint are dropped; a retry
+            # comes within moments, not a whole compaction cycle later
+            ledger_keys = {key: seq for key, seq in ledger_keys.items() if seq > checkpoint_seq}
+            checkpoint = {'seq': ledger_seq, 'balances': dict(tanga_balances), 'keys': dict(ledger_keys)}
+        # Entries folded into the checkpoint must already be in user.json
+        save_json('user.json', users)
+        save_json(LEDGER_CHECKPOINT, checkpoint)
+        with sync_lock, ledger_lock:
+            ledger_file.close()
+            with open(LEDGER_FILE, 'r') as f:
+                tail = [line for line in f if line.strip() and json.loads(line)['seq'] > checkpoint['seq']]
+            write_atomic(LEDGER_FILE, ''.join(tail).encode())
+            ledger_file = open(LEDGER_FILE, 'a')
+            ledger_pending = len(tail)
+            checkpoint_seq = checkpoint['seq']
+            # The checkpoint and the rewritten tail were written synced
+            if FSYNC_POLICY != 'never':
+                ledger_synced = ledger_seq
+        logging.info(f"Tanga ledger compacted at seq {checkpoint['seq']}")
+    finally:
+        compact_lock.release()
+
+user_id_lock = threading.Lock()
 
 def generate_user_id():
-    max_id = max([int(user['user_id']) for user in users.values()] or [0])
-    return str(max_id + 1).zfill(5)
+    global last_user_id
+    with user_id_lock:
+        last_user_id += 1
+        return str(last_user_id).zfill(5)
+
+def find_test(test_id):
+    for class_id, class_tests in tests.items():
+        if test_id in class_tests:
+            return class_id, class_tests[test_id]
+    return None, None
+
+# A pool-based test is {'pool', 'sample', 'weights'} instead of a question
+# list. Each attempt stores the pool indices it drew, so the questions of an
+# attempt are looked up here rather than read from the test.
+def get_attempt_questions(class_id, test_data, result):
+    if 'pool' not in test_data:
+        return test_data['questions']
+    pool = pools.get(str(class_id), {}).get(test_data['pool'], [])
+    return [pool[idx] for idx in (result or {}).get('questions', []) if idx < len(pool)]
+
+def question_tags(question):
+    return [f"{field}:{question[field]}" for field in ('topic', 'difficulty') if question.get(field)]
+
+# Tag -> pool indices, and alias tables per set of weights; both are built on
+# first use and dropped when the pool changes. Pools only ever grow, so the
+# indices stored in attempts stay valid.
+pool_tag_indexes = {}
+pool_alias_tables = {}
+
+def pool_tag_index(class_id, pool_name):
+    key = (str(class_id), pool_name)
+    index = pool_tag_indexes.get(key)
+    if index is None:
+        index = {}
+        for idx, question in enumerate(pools.get(key[0], {}).get(pool_name, [])):
+            for tag in question_tags(question):
+                index.setdefault(tag, []).append(idx)
+        pool_tag_indexes[key] = index
+    return index
+
+def pool_weights(class_id, pool_name, weights):
+    # A question's weight is the product of the weights of its tags; tags
+    # that are not mentioned count as 1 and a weight of 0 leaves it out
+    pool = pools.get(str(class_id), {}).get(pool_name, [])
+    question_weights = [1.0] * len(pool)
+    index = pool_tag_index(class_id, pool_name)
+    for tag, weight in weights.items():
+        for idx in index.get(tag, []):
+            question_weights[idx] *= weight
+    return question_weights
+
+def pool_alias_table(class_id, pool_name, weights):
+    # Vose's alias method: O(n) to build, O(1) per draw
+    key = (str(class_id), pool_name, len(pools.get(str(class_id), {}).get(pool_name, [])), tuple(sorted(weights.items())))
+    table = pool_alias_tables.get(key)
+    if table is None:
+        question_weights = pool_weights(class_id, pool_name, weights)
+        count = len(question_weights)
+        total = sum(question_weights)
+        support = sum(1 for weight in question_weights if weight > 0)
+        if not support:
+            table = pool_alias_tables[key] = ([], [], 0)
+            return table
+        prob = [weight * count / total for weight in question_weights]
+        alias = list(range(count))
+        small = [idx for idx, p in enumerate(prob) if p < 1]
+        large = [idx for idx, p in enumerate(prob) if p >= 1]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            alias[less] = more
+            prob[more] -= 1 - prob[less]
+            (small if prob[more] < 1 else large).append(more)
+        # Only rounding leftovers end up here
+        fallback = next(idx for idx, weight in enumerate(question_weights) if weight > 0)
+        for idx in small + large:
+            if question_weights[idx] > 0:
+                prob[idx] = 1
+            else:
+                prob[idx], alias[idx] = 0, fallback
+        table = pool_alias_tables[key] = (prob, alias, support)
+    return table
+
+def sample_pool_questions(class_id, test_data):
+    prob, alias, support = pool_alias_table(class_id, test_data['pool'], test_data.get('weights', {}))
+    sample = min(test_data['sample'], support)
+    chosen = []
+    seen = set()
+    draws = 0
+    while len(chosen) < sample and draws < 50 * sample:
+        draws += 1
+        idx = random.randrange(len(prob))
+        if random.random() >= prob[idx]:
+            idx = alias[idx]
+        # Repeats are drawn again, so each question appears once
+        if idx not in seen:
+            seen.add(idx)
+            chosen.append(idx)
+    if len(chosen) < sample:
+        # Heavily skewed weights: fill up from what is left
+        question_weights = pool_weights(class_id, test_data['pool'], test_data.get('weights', {}))
+        rest = [idx for idx, weight in enumerate(question_weights) if weight > 0 and idx not in seen]
+        random.shuffle(rest)
+        chosen.extend(rest[:sample - len(chosen)])
+    return chosen
 
 def is_valid_phone_number(phone):
     return re.fullmatch(r'^\+998\d{9}$', phone) is not None
@@ -60,12 +883,13 @@ def ensure_user_info(message):
     if not check_channel_subscription(user_id):
         ask_to_join_channels(message)
         return
-    if user_id not in users:
-        users[user_id] = {
-            'user_id': generate_user_id(),
-            'tests': {},
-            'tanga': 0
-        }
+    with user_lock(user_id):
+        if user_id not in users:
+            users[user_id] = {
+                'user_id': generate_user_id(),
+                'tests': {},
+                'tanga': 0
+            }
     missing_fields = [field for field in ['name', 'age', 'phone', 'class', 'region', 'district'] if field not in users[user_id]]
     if missing_fields:
         request_user_info(message, missing_fields)
@@ -74,7 +898,7 @@ def ensure_user_info(message):
     save_json('user.json', users)
 
 def check_channel_subscription(user_id):
-    for channel in required_channels:
+    for channel in list(required_channels):
         try:
             member = bot.get_chat_member(f"@{channel}", user_id)
             if member.status not in ['member', 'administrator', 'creator']:
@@ -129,7 +953,8 @@ def process_user_name(message, fields):
         ensure_user_info(message)
         return
     user_id = str(message.chat.id)
-    users[user_id]['name'] = message.text
+    with user_lock(user_id):
+        users[user_id]['name'] = message.text
     save_json('user.json', users)
     request_user_info(message, fields)
 
@@ -144,7 +969,8 @@ def process_user_age(message, fields):
             bot.register_next_step_handler(msg, process_user_age, fields)
             return
         user_id = str(message.chat.id)
-        users[user_id]['age'] = age
+        with user_lock(user_id):
+            users[user_id]['age'] = age
         save_json('user.json', users)
         request_user_info(message, fields)
     except ValueError:
@@ -162,7 +988,8 @@ def process_user_phone(message, fields):
         bot.register_next_step_handler(msg, process_user_phone, fields)
         return
     user_id = str(message.chat.id)
-    users[user_id]['phone'] = phone
+    with user_lock(user_id):
+        users[user_id]['phone'] = phone
     save_json('user.json', users)
     request_user_info(message, fields)
 
@@ -177,7 +1004,7 @@ def process_user_class(message, fields):
             bot.register_next_step_handler(msg, process_user_class, fields)
             return
         user_id = str(message.chat.id)
-        users[user_id]['class'] = class_id
+        update_user_profile(user_id, {'class': class_id})
         save_json('user.json', users)
         request_user_info(message, fields)
     except ValueError:
@@ -190,12 +1017,12 @@ def process_user_region(message, fields):
         ensure_user_info(message)
         return
     user_id = str(message.chat.id)
-    region = message.text
-    if region not in viloyatlar:
-        msg = bot.send_message(message.chat.id, "Noto'g'ri viloyat. Iltimos, qaytadan tanlang:")
+    region, suggestions = match_place(region_index, message.text)
+    if region is None:
+        msg = ask_place_again(message, "Noto'g'ri viloyat. Iltimos, qaytadan tanlang:", suggestions)
         bot.register_next_step_handler(msg, process_user_region, fields)
         return
-    users[user_id]['region'] = region
+    update_user_profile(user_id, {'region': region})
     save_json('user.json', users)
     request_user_info(message, fields)
 
@@ -204,20 +1031,95 @@ def process_user_district(message, fields):
         ensure_user_info(message)
         return
     user_id = str(message.chat.id)
-    district = message.text
-    if 'tuman' not in district.lower():
-        district += ' tuman'
-    if district not in address[users[user_id]['region']]:
-        msg = bot.send_message(message.chat.id, "Noto'g'ri tuman. Iltimos, qaytadan tanlang:")
+    district, suggestions = match_place(district_indexes[users[user_id]['region']], message.text)
+    if district is None:
+        msg = ask_place_again(message, "Noto'g'ri tuman. Iltimos, qaytadan tanlang:", suggestions)
         bot.register_next_step_handler(msg, process_user_district, fields)
         return
-    users[user_id]['district'] = district
+    update_user_profile(user_id, {'district': district})
     save_json('user.json', users)
     ensure_user_info(message)
 
+# Participant, score and tanga rollups per region, district and class.
+# Built on first use so startup does not have to hydrate every user.
+rollups = None
+
+def rollup_buckets(user):
+    if rollups is None:
+        return []
+    keys = []
+    if 'region' in user:
+        keys.append(('region', user['region']))
+        if 'district' in user:
+            keys.append(('district', f"{user['region']}|{user['district']}"))
+    if 'class' in user:
+        keys.append(('class', str(user['class'])))
+    return [rollups[level].setdefault(key, {'users': 0, 'tanga': 0, 'tests': {}}) for level, key in keys]
+
+def rollup_add_score(buckets, test_id, score, sign):
+    for bucket in buckets:
+        totals = bucket['tests'].setdefault(test_id, [0, 0])
+        totals[0] += sign
+        totals[1] += sign * score
+
+def rollup_user(user, sign=1):
+    with stats_lock:
+        buckets = rollup_buckets(user)
+        if not buckets:
+            return
+        for bucket in buckets:
+            bucket['users'] += sign
+            bucket['tanga'] += sign * user.get('tanga', 0)
+        for test_id, result in user.get('tests', {}).items():
+            class_id, test_data = find_test(test_id)
+            if test_data is not None and is_test_finished(result, get_attempt_questions(class_id, test_data, result)):
+                rollup_add_score(buckets, test_id, result['score'], sign)
+
+def rollup_test_result(user, test_id, score, sign=1):
+    with stats_lock:
+        rollup_add_score(rollup_buckets(user), test_id, score, sign)
+
+def rollup_tanga(user, amount):
+    with stats_lock:
+        for bucket in rollup_buckets(user):
+            bucket['tanga'] += amount
+
+def rebuild_rollups():
+    global rollups
+    with all_user_locks(), stats_lock:
+        rollups = {'region': {}, 'district': {}, 'class': {}}
+        try:
+            for _, user in users.scan():
+                rollup_user(user)
+        except Exception:
+            # Half-built rollups would show wrong numbers; build them next time
+            rollups = None
+            raise
+
+def ensure_rollups():
+    if rollups is None:
+        rebuild_rollups()
+    return rollups
+
+def update_user_profile(user_id, fields):
+    with user_lock(user_id):
+        user = users[user_id]
+        rollup_user(user, -1)
+        for field, value in fields.items():
+            if value is None:
+                user.pop(field, None)
+            else:
+                user[field] = value
+        rollup_user(user)
+
 # Admin panel
 def admin_panel(message):
     if not is_admin(message.chat.id):
+        if is_test_author(message.chat.id):
+            markup = types.ReplyKeyboardMarkup(row_width=2)
+            markup.add(types.KeyboardButton('📄 Test yuklash'), types.KeyboardButton('📥 Savollar hovuzi'), types.KeyboardButton('🎲 Hovuzdan test'), types.KeyboardButton('⬅Ortga'))
+            bot.send_message(message.chat.id, "Test mualliflari paneliga xush kelibsiz!", reply_markup=markup)
+            return
         bot.send_message(message.chat.id, "Sizda admin huquqlari yo'q.")
         return
     
@@ -229,7 +1131,13 @@ def admin_panel(message):
     manage_channels = types.KeyboardButton('📺 Kanallarni boshqarish')
     give_tanga = types.KeyboardButton('💰 Tangalar berish')
     broadcast_message = types.KeyboardButton('📢 Barchaga xabar yuborish')
-    markup.add(test_upload, view_results, view_users, manage_admins, manage_channels, give_tanga, broadcast_message)
+    statistics = types.KeyboardButton('📈 Statistika')
+    region_statistics = types.KeyboardButton('🗺 Hududlar statistikasi')
+    top_tanga = types.KeyboardButton('🏆 Top tangalar')
+    question_pool = types.KeyboardButton('📥 Savollar hovuzi')
+    pool_test = types.KeyboardButton('🎲 Hovuzdan test')
+    archive = types.KeyboardButton('📦 Arxiv')
+    markup.add(test_upload, view_results, view_users, manage_admins, manage_channels, give_tanga, broadcast_message, statistics, region_statistics, top_tanga, question_pool, pool_test, archive)
     bot.send_message(message.chat.id, "Admin paneliga xush kelibsiz!", reply_markup=markup)
 
 def back_to_admin_main(message):
@@ -245,12 +1153,18 @@ def back_to_admin_main(message):
     manage_channels = types.KeyboardButton('📺 Kanallarni boshqarish')
     give_tanga = types.KeyboardButton('💰 Tangalar berish')
     broadcast_message = types.KeyboardButton('📢 Barchaga xabar yuborish')
-    markup.add(test_upload, view_results, view_users, manage_admins, manage_channels, give_tanga, broadcast_message)
+    statistics = types.KeyboardButton('📈 Statistika')
+    region_statistics = types.KeyboardButton('🗺 Hududlar statistikasi')
+    top_tanga = types.KeyboardButton('🏆 Top tangalar')
+    question_pool = types.KeyboardButton('📥 Savollar hovuzi')
+    pool_test = types.KeyboardButton('🎲 Hovuzdan test')
+    archive = types.KeyboardButton('📦 Arxiv')
+    markup.add(test_upload, view_results, view_users, manage_admins, manage_channels, give_tanga, broadcast_message, statistics, region_statistics, top_tanga, question_pool, pool_test, archive)
 
     bot.send_message(message.chat.id, "Admin panelining asosiy menyusiga qaytdingiz!", reply_markup=markup)
 
 def upload_test(message):
-    if not is_admin(message.chat.id):
+    if not is_admin(message.chat.id) and not is_test_author(message.chat.id):
         bot.send_message(message.chat.id, "Sizda admin huquqlari yo'q.")
         return
     
@@ -271,6 +1185,10 @@ def process_class_step(message):
             msg = bot.send_message(message.chat.id, "Sinf 1 va 12 oralig'ida bo'lishi kerak. Iltimos, sinfni qaytadan kiriting:")
             bot.register_next_step_handler(msg, process_class_step)
             return
+        if not is_admin(message.chat.id) and not is_test_author(message.chat.id, class_id):
+            msg = bot.send_message(message.chat.id, "Siz bu sinf uchun test yuklay olmaysiz. Iltimos, boshqa sinfni kiriting:")
+            bot.register_next_step_handler(msg, process_class_step)
+            return
         if class_id not in tests:
             tests[class_id] = {}
         msg = bot.send_message(message.chat.id, "Endi test ID kiritishingiz kerak:")
@@ -335,6 +1253,12 @@ def process_end_time_step(message, class_id, test_id, start_datetime):
             return
         
         tests[class_id][test_id]['end_time'] = end_time
+        if 'pool' in tests[class_id][test_id]:
+            # Pool tests have no questions of their own
+            save_json('test_data.json', tests)
+            bot.send_message(message.chat.id, "Test muvaffaqiyatli saqlandi va yakunlandi!")
+            back_to_admin_main(message)
+            return
         
         markup = types.ReplyKeyboardMarkup(row_width=2)
         back_button = types.KeyboardButton('⬅Ortga')
@@ -358,11 +1282,18 @@ def process_question_step(message, class_id, test_id):
         back_to_admin_main(message)
         return
 
-    question_text = message.text
-    msg = bot.send_message(message.chat.id, "Variantlar sonini kiriting:")
-    bot.register_next_step_handler(msg, process_option_count_step, class_id, test_id, question_text)
+    # Images and documents are kept by the file_id Telegram gave us for the
+    # admin's upload, so students are sent a reference, never the bytes
+    media = None
+    if message.content_type == 'photo':
+        media = {'type': 'photo', 'file_id': message.photo[-1].file_id}
+    elif message.content_type == 'document':
+        media = {'type': 'document', 'file_id': message.document.file_id}
+    question_text = (message.caption or '') if media else message.text
+    msg = bot.send_message(message.chat.id, "Variantlar sonini kiriting yoki har bir variantni yangi qatordan yozing:")
+    bot.register_next_step_handler(msg, process_option_count_step, class_id, test_id, question_text, media)
 
-def process_option_count_step(message, class_id, test_id, question_text):
+def process_option_count_step(message, class_id, test_id, question_text, media=None):
     if message.text == '✅ Yakunlash':
         save_json('test_data.json', tests)
         bot.send_message(message.chat.id, "Test muvaffaqiyatli saqlandi va yakunlandi!")
@@ -373,15 +1304,25 @@ def process_option_count_step(message, class_id, test_id, question_text):
         back_to_admin_main(message)
         return
 
+    # Options written out one per line are shown under the question and
+    # shuffled per student; a bare number keeps them inside the question
+    options = [line.strip() for line in (message.text or '').splitlines() if line.strip()]
+    if len(options) < 2:
+        options = None
     try:
-        option_count = int(message.text)
+        option_count = len(options) if options else int(message.text)
         if option_count < 2:
             msg = bot.send_message(message.chat.id, "Iltimos, kamida 2 ta variant kiriting:")
-            bot.register_next_step_handler(msg, process_option_count_step, class_id, test_id, question_text)
+            bot.register_next_step_handler(msg, process_option_count_step, class_id, test_id, question_text, media)
             return
 
         questions = tests[class_id][test_id]['questions']
-        questions.append({'question': question_text, 'option_count': option_count})
+        question = {'question': question_text, 'option_count': option_count}
+        if options:
+            question['options'] = options
+        if media:
+            question['media'] = media
+        questions.append(question)
 
         markup = types.ReplyKeyboardMarkup(row_width=2)
         for idx in range(option_count):
@@ -391,7 +1332,7 @@ def process_option_count_step(message, class_id, test_id, question_text):
 
     except ValueError:
         msg = bot.send_message(message.chat.id, "Iltimos, raqam kiriting:")
-        bot.register_next_step_handler(msg, process_option_count_step, class_id, test_id, question_text)
+        bot.register_next_step_handler(msg, process_option_count_step, class_id, test_id, question_text, media)
         return
 
 def process_correct_answer_step(message, class_id, test_id, question_text, option_count):
@@ -407,6 +1348,202 @@ def process_correct_answer_step(message, class_id, test_id, question_text, optio
     msg = bot.send_message(message.chat.id, "Yangi savolni kiriting yoki '✅ Yakunlash' tugmasini bosing:", reply_markup=markup)
     bot.register_next_step_handler(msg, process_question_step, class_id, test_id)
 
+def question_pool_menu(message, action):
+    if not is_admin(message.chat.id) and not is_test_author(message.chat.id):
+        bot.send_message(message.chat.id, "Sizda admin huquqlari yo'q.")
+        return
+
+    markup = types.ReplyKeyboardMarkup(row_width=2)
+    markup.add(types.KeyboardButton('⬅Ortga'))
+    msg = bot.send_message(message.chat.id, "Iltimos, sinfni kiriting (masalan, 9):", reply_markup=markup)
+    bot.register_next_step_handler(msg, process_pool_class_step, action)
+
+def process_pool_class_step(message, action):
+    if message.text == '⬅Ortga':
+        back_to_admin_main(message)
+        return
+    try:
+        class_id = int(message.text)
+    except (TypeError, ValueError):
+        msg = bot.send_message(message.chat.id, "Iltimos, to'g'ri sinf raqamini kiriting:")
+        bot.register_next_step_handler(msg, process_pool_class_step, action)
+        return
+    if class_id < 1 or class_id > 12:
+        msg = bot.send_message(message.chat.id, "Sinf 1 va 12 oralig'ida bo'lishi kerak. Iltimos, sinfni qaytadan kiriting:")
+        bot.register_next_step_handler(msg, process_pool_class_step, action)
+        return
+    if not is_admin(message.chat.id) and not is_test_author(message.chat.id, class_id):
+        msg = bot.send_message(message.chat.id, "Siz bu sinf uchun test yuklay olmaysiz. Iltimos, boshqa sinfni kiriting:")
+        bot.register_next_step_handler(msg, process_pool_class_step, action)
+        return
+
+    if action == 'import':
+        msg = bot.send_message(message.chat.id, "Hovuz nomini kiriting:")
+        bot.register_next_step_handler(msg, process_pool_name_step, class_id)
+        return
+    class_pools = pools.get(str(class_id), {})
+    if not class_pools:
+        bot.send_message(message.chat.id, "Bu sinf uchun savollar hovuzi yo'q.")
+        back_to_admin_main(message)
+        return
+    markup = types.ReplyKeyboardMarkup(row_width=2)
+    for pool_name in class_pools:
+        markup.add(types.KeyboardButton(pool_name))
+    markup.add(types.KeyboardButton('⬅Ortga'))
+    msg = bot.send_message(message.chat.id, "Hovuzni tanlang:", reply_markup=markup)
+    bot.register_next_step_handler(msg, process_pool_test_pool_step, class_id)
+
+def process_pool_name_step(message, class_id):
+    if message.text == '⬅Ortga':
+        back_to_admin_main(message)
+        return
+    if not message.text:
+        msg = bot.send_message(message.chat.id, "Iltimos, hovuz nomini matn bilan kiriting:")
+        bot.register_next_step_handler(msg, process_pool_name_step, class_id)
+        return
+    msg = bot.send_message(
+        message.chat.id,
+        "Savollarni JSON fayl yoki matn ko'rinishida yuboring. Har bir savol: "
+        '{"question": "...", "options": ["...", "..."], "correct_answer": "A", "topic": "...", "difficulty": "..."}'
+    )
+    bot.register_next_step_handler(msg, process_pool_file_step, class_id, message.text.strip())
+
+def parse_pool_questions(data):
+    if isinstance(data, dict):
+        data = data.get('questions')
+    if not isinstance(data, list) or not data:
+        raise ValueError("savollar ro'yxati topilmadi")
+    questions = []
+    for number, item in enumerate(data, start=1):
+        if not isinstance(item, dict) or not isinstance(item.get('question'), str):
+            raise ValueError(f"{number}-savol matni yo'q")
+        question = {'question': item['question']}
+        options = item.get('options')
+        if options is not None:
+            if not isinstance(options, list) or len(options) < 2:
+                raise ValueError(f"{number}-savolda kamida 2 ta variant bo'lishi kerak")
+            question['options'] = [str(option) for option in options]
+            question['option_count'] = len(options)
+        else:
+            question['option_count'] = item.get('option_count')
+            if not isinstance(question['option_count'], int) or question['option_count'] < 2:
+                raise ValueError(f"{number}-savolda variantlar soni noto'g'ri")
+        correct_answer = str(item.get('correct_answer', '')).strip().upper()
+        if len(correct_answer) != 1 or not 0 <= ord(correct_answer) - 65 < question['option_count']:
+            raise ValueError(f"{number}-savolning to'g'ri javobi noto'g'ri")
+        question['correct_answer'] = correct_answer
+        for field in ('topic', 'difficulty'):
+            if item.get(field):
+                question[field] = str(item[field])
+        questions.append(question)
+    return questions
+
+def process_pool_file_step(message, class_id, pool_name):
+    if message.text == '⬅Ortga':
+        back_to_admin_main(message)
+        return
+    try:
+        if message.content_type == 'document':
+            file_info = bot.get_file(message.document.file_id)
+            data = json.loads(bot.download_file(file_info.file_path))
+        else:
+            data = json.loads(message.text or '')
+        questions = parse_pool_questions(data)
+    except ValueError as e:
+        msg = bot.send_message(message.chat.id, f"Savollarni o'qib bo'lmadi: {e}. Iltimos, qaytadan yuboring:")
+        bot.register_next_step_handler(msg, process_pool_file_step, class_id, pool_name)
+        return
+
+    with pools_lock:
+        pool = pools.setdefault(str(class_id), {}).setdefault(pool_name, [])
+        pool.extend(questions)
+        pool_tag_indexes.pop((str(class_id), pool_name), None)
+        for key in [key for key in pool_alias_tables if key[:2] == (str(class_id), pool_name)]:
+            pool_alias_tables.pop(key, None)
+        save_json('pools.json', pools)
+        total = len(pool)
+
+    index = pool_tag_index(class_id, pool_name)
+    tags = "\n".join([f"{tag}: {len(indices)} ta" for tag, indices in sorted(index.items())[:30]]) or "yo'q"
+    bot.send_message(message.chat.id, f"{len(questions)} ta savol qo'shildi. '{pool_name}' hovuzida jami {total} ta savol.\n\nTeglar:\n{tags}")
+    back_to_admin_main(message)
+
+def process_pool_test_pool_step(message, class_id):
+    if message.text == '⬅Ortga':
+        back_to_admin_main(message)
+        return
+    if message.text not in pools.get(str(class_id), {}):
+        msg = bot.send_message(message.chat.id, "Bunday hovuz topilmadi. Iltimos, ro'yxatdan tanlang:")
+        bot.register_next_step_handler(msg, process_pool_test_pool_step, class_id)
+        return
+    msg = bot.send_message(message.chat.id, "Endi test ID kiritishingiz kerak:", reply_markup=types.ReplyKeyboardRemove())
+    bot.register_next_step_handler(msg, process_pool_test_id_step, class_id, message.text)
+
+def process_pool_test_id_step(message, class_id, pool_name):
+    if message.text == '⬅Ortga':
+        back_to_admin_main(message)
+        return
+    test_id = message.text
+    if find_test(test_id)[1] is not None:
+        msg = bot.send_message(message.chat.id, "Bu test ID allaqachon mavjud. Iltimos, boshqa test ID kiritishingiz kerak:")
+        bot.register_next_step_handler(msg, process_pool_test_id_step, class_id, pool_name)
+        return
+    msg = bot.send_message(message.chat.id, "Har bir o'quvchiga nechta savol berilsin?")
+    bot.register_next_step_handler(msg, process_pool_sample_step, class_id, pool_name, test_id)
+
+def process_pool_sample_step(message, class_id, pool_name, test_id):
+    if message.text == '⬅Ortga':
+        back_to_admin_main(message)
+        return
+    try:
+        sample = int(message.text)
+        if sample < 1:
+            raise ValueError
+    except (TypeError, ValueError):
+        msg = bot.send_message(message.chat.id, "Iltimos, musbat son kiriting:")
+        bot.register_next_step_handler(msg, process_pool_sample_step, class_id, pool_name, test_id)
+        return
+    tags = ", ".join(sorted(pool_tag_index(class_id, pool_name))[:30]) or "yo'q"
+    msg = bot.send_message(
+        message.chat.id,
+        f"Teglar bo'yicha og'irliklarni JSON ko'rinishida kiriting (masalan, {{\"difficulty:hard\": 2, \"topic:geometriya\": 0}}) yoki '-' yuboring.\n\nTeglar: {tags}"
+    )
+    bot.register_next_step_handler(msg, process_pool_weights_step, class_id, pool_name, test_id, sample)
+
+def process_pool_weights_step(message, class_id, pool_name, test_id, sample):
+    if message.text == '⬅Ortga':
+        back_to_admin_main(message)
+        return
+    try:
+        weights = {} if (message.text or '').strip() == '-' else json.loads(message.text or '')
+        if not isinstance(weights, dict):
+            raise ValueError("JSON obyekt kerak")
+        index = pool_tag_index(class_id, pool_name)
+        for tag, weight in weights.items():
+            if tag not in index:
+                raise ValueError(f"'{tag}' tegi hovuzda yo'q")
+            if not isinstance(weight, (int, float)) or weight < 0:
+                raise ValueError(f"'{tag}' og'irligi manfiy bo'lmagan son bo'lishi kerak")
+    except ValueError as e:
+        msg = bot.send_message(message.chat.id, f"Og'irliklar noto'g'ri: {e}. Iltimos, qaytadan kiriting:")
+        bot.register_next_step_handler(msg, process_pool_weights_step, class_id, pool_name, test_id, sample)
+        return
+
+    _, _, support = pool_alias_table(class_id, pool_name, weights)
+    if support < sample:
+        msg = bot.send_message(message.chat.id, f"Bu og'irliklar bilan faqat {support} ta savol tanlanishi mumkin. Iltimos, og'irliklarni qaytadan kiriting:")
+        bot.register_next_step_handler(msg, process_pool_weights_step, class_id, pool_name, test_id, sample)
+        return
+
+    if class_id not in tests:
+        tests[class_id] = {}
+    tests[class_id][test_id] = {'test_id': test_id, 'pool': pool_name, 'sample': sample, 'weights': weights}
+
+    markup = types.ReplyKeyboardMarkup(row_width=2)
+    markup.add(types.KeyboardButton('⬅Ortga'))
+    msg = bot.send_message(message.chat.id, "Testning boshlanish vaqtini kiriting (YYYY-MM-DD HH:MM):", reply_markup=markup)
+    bot.register_next_step_handler(msg, process_start_time_step, class_id, test_id)
+
 def manage_admins(message):
     if not is_admin(message.chat.id):
         bot.send_message(message.chat.id, "Sizda admin huquqlari yo'q.")
@@ -416,8 +1553,10 @@ def manage_admins(message):
     add_admin = types.KeyboardButton('Yangi admin qo\'shish')
     remove_admin = types.KeyboardButton('Adminni o\'chirish')
     view_admins = types.KeyboardButton('Adminlar ro\'yxati')
+    add_author = types.KeyboardButton('Test muallifi qo\'shish')
+    remove_author = types.KeyboardButton('Test muallifini o\'chirish')
     back_button = types.KeyboardButton('⬅Ortga')
-    markup.add(add_admin, remove_admin, view_admins, back_button)
+    markup.add(add_admin, remove_admin, view_admins, add_author, remove_author, back_button)
     bot.send_message(message.chat.id, "Adminlarni boshqarish paneli:", reply_markup=markup)
 
 def add_admin_step(message):
@@ -439,12 +1578,16 @@ def process_add_admin(message):
     if new_admin_id not in users:
         bot.send_message(message.chat.id, "Chat ID mavjud foydalanuvchi emas.")
         return
-    if new_admin_id not in admins:
-        admins.add(new_admin_id)
+    def add(data):
+        if new_admin_id in data['admins'] or new_admin_id == MAIN_ADMIN_ID:
+            return False
+        data['admins'].append(new_admin_id)
+        return True
+
+    if change_roles(add):
         bot.send_message(message.chat.id, f"Chat ID {new_admin_id} admin qilib qo'shildi.")
     else:
         bot.send_message(message.chat.id, f"Chat ID {new_admin_id} allaqachon admin.")
-    save_json('user.json', users)
 
 def remove_admin_step(message):
     if not is_admin(message.chat.id) or str(message.chat.id) != MAIN_ADMIN_ID:
@@ -459,21 +1602,76 @@ def process_remove_admin(message):
         back_to_admin_main(message)
         return
     remove_admin_id = message.text
-    if remove_admin_id in admins:
-        admins.remove(remove_admin_id)
+    def remove(data):
+        if remove_admin_id not in data['admins']:
+            return False
+        data['admins'].remove(remove_admin_id)
+        return True
+
+    if remove_admin_id == MAIN_ADMIN_ID:
+        bot.send_message(message.chat.id, "Asosiy adminni o'chirib bo'lmaydi.")
+    elif change_roles(remove):
         bot.send_message(message.chat.id, f"Chat ID {remove_admin_id} adminlardan o'chirildi.")
     else:
         bot.send_message(message.chat.id, f"Chat ID {remove_admin_id} admin emas.")
-    save_json('user.json', users)
 
 def view_admins_list(message):
     if not is_admin(message.chat.id):
         bot.send_message(message.chat.id, "Sizda admin huquqlari yo'q.")
         return
     
-    admin_list = "Adminlar ro'yxati:\n" + "\n".join(admins)
+    current = current_roles()
+    admin_list = "Adminlar ro'yxati:\n" + "\n".join(sorted(current.admins))
+    if current.authors:
+        admin_list += "\n\nTest mualliflari:\n" + "\n".join([
+            f"{chat_id}: {', '.join(map(str, sorted(classes)))}-sinf" for chat_id, classes in sorted(current.authors.items())
+        ])
     bot.send_message(message.chat.id, admin_list)
 
+def author_step(message):
+    if not is_admin(message.chat.id):
+        bot.send_message(message.chat.id, "Sizda admin huquqlari yo'q.")
+        return
+
+    msg = bot.send_message(message.chat.id, "Chat ID va sinfni kiriting (masalan, 123456789 9):")
+    bot.register_next_step_handler(msg, process_author, message.text == 'Test muallifi qo\'shish')
+
+def process_author(message, add):
+    if message.text == '⬅Ortga':
+        back_to_admin_main(message)
+        return
+    parts = message.text.split()
+    if len(parts) != 2 or not parts[0].isdigit() or not parts[1].isdigit() or not 1 <= int(parts[1]) <= 12:
+        bot.send_message(message.chat.id, "Noto'g'ri format. Chat ID va 1-12 oralig'idagi sinfni kiriting.")
+        return
+    author_id, class_id = parts[0], int(parts[1])
+    if add and author_id not in users:
+        bot.send_message(message.chat.id, "Chat ID mavjud foydalanuvchi emas.")
+        return
+
+    def change(data):
+        classes = data['authors'].setdefault(author_id, [])
+        changed = False
+        if add and class_id not in classes:
+            classes.append(class_id)
+            changed = True
+        elif not add and class_id in classes:
+            classes.remove(class_id)
+            changed = True
+        if not classes:
+            del data['authors'][author_id]
+        return changed
+
+    changed = change_roles(change)
+    if add and changed:
+        bot.send_message(message.chat.id, f"Chat ID {author_id} {class_id}-sinf uchun test muallifi qilib qo'shildi.")
+    elif add:
+        bot.send_message(message.chat.id, f"Chat ID {author_id} allaqachon {class_id}-sinf test muallifi.")
+    elif changed:
+        bot.send_message(message.chat.id, f"Chat ID {author_id} {class_id}-sinf test mualliflaridan o'chirildi.")
+    else:
+        bot.send_message(message.chat.id, f"Chat ID {author_id} {class_id}-sinf test muallifi emas.")
+
 def show_user_main_menu(message):
     markup = types.ReplyKeyboardMarkup(row_width=2)
     test_start = types.KeyboardButton('📄 Test boshlash')
@@ -517,56 +1715,215 @@ def process_test_id(message):
             elif now > end_time:
                 bot.send_message(message.chat.id, "Test tugagan.")
                 return
-            users[user_id]['tests'][test_id] = {'answers': [], 'score': 0}
+            with user_lock(user_id):
+                previous = users[user_id]['tests'].get(test_id)
+                if previous and is_test_finished(previous, get_attempt_questions(class_id, test_data, previous)):
+                    record_test_result(test_id, previous.get('answers', []), get_attempt_questions(class_id, test_data, previous), previous['score'], -1, previous.get('questions'))
+                    rollup_test_result(users[user_id], test_id, previous['score'], -1)
+                # A new draw needs a new order
+                drop_attempt_order(user_id, test_id, previous)
+                attempt = {'answers': [], 'score': 0, 'started': int(time.time())}
+                if SHUFFLE_QUESTIONS:
+                    attempt['shuffled'] = True
+                if 'pool' in test_data:
+                    attempt['questions'] = sample_pool_questions(class_id, test_data)
+                users[user_id]['tests'][test_id] = attempt
+                record_test_score(test_id, user_id, 0)
             save_json('user.json', users)
             ask_question(message, class_id, test_id, 0)
             return
     bot.send_message(message.chat.id, "Test topilmadi.")
 
-def ask_question(message, class_id, test_id, question_index):
+def ask_question(message, class_id, test_id, question_index, edit_message=None):
     if not check_channel_subscription(message.chat.id):
         ask_to_join_channels(message)
         return
-    if question_index < len(tests[class_id][test_id]['questions']):
-        question_data = tests[class_id][test_id]['questions'][question_index]
-        question_text = question_data['question']
-        option_count = question_data['option_count']
-        markup = types.ReplyKeyboardMarkup(row_width=1, one_time_keyboard=True)
-        for idx in range(option_count):
-            markup.add(types.KeyboardButton(chr(65 + idx)))
-        msg = bot.send_message(message.chat.id, question_text, reply_markup=markup)
+    result = users[str(message.chat.id)]['tests'].get(test_id)
+    questions = get_attempt_questions(class_id, tests[class_id][test_id], result)
+    if question_index < len(questions):
+        question_order, option_orders = attempt_order(message.chat.id, test_id, questions, result)
+        question_data = questions[question_order[question_index]]
+        option_order = option_orders[question_index]
+        if uses_inline_answers(test_id):
+            markup = inline_option_keyboard(test_id, question_index, question_data['option_count'])
+            send_question(message.chat.id, question_data, option_order, markup, edit_message)
+            return
+        msg = send_question(message.chat.id, question_data, option_order, option_keyboard(question_data['option_count']))
         bot.register_next_step_handler(msg, process_answer, class_id, test_id, question_index)
     else:
+        if edit_message is not None:
+            bot.edit_message_reply_markup(message.chat.id, edit_message.message_id, reply_markup=None)
         calculate_score(message, class_id, test_id)
 
+# Question and option order per attempt. The order comes from a seed, so an
+# attempt only stores 'shuffled': True; attempts without it (started before
+# shuffling, or with SHUFFLE_QUESTIONS off) keep the test's order. The cache
+# only saves reshuffling on every question: entries are dropped when the
+# attempt is scored, restarted or abandoned, and since any entry can be
+# rebuilt, the oldest go once there are ATTEMPT_ORDER_CACHE of them.
+attempt_orders = {}
+attempt_orders_lock = threading.Lock()
+
+def attempt_order_key(user_id, test_id, result):
+    return (str(user_id), test_id, (result or {}).get('started'))
+
+def attempt_order(user_id, test_id, questions, result):
+    key = attempt_order_key(user_id, test_id, result)
+    order = attempt_orders.get(key)
+    if order is None or len(order[0]) != len(questions):
+        shuffled = bool((result or {}).get('shuffled'))
+        seed = int.from_bytes(hashlib.sha256(f"{key[0]}:{test_id}".encode()).digest()[:8], 'big')
+        rng = random.Random(seed)
+        question_order = list(range(len(questions)))
+        if shuffled:
+            rng.shuffle(question_order)
+        option_orders = []
+        for idx in question_order:
+            option_order = list(range(questions[idx]['option_count']))
+            # Only options listed in the question can move; letters that refer
+            # to choices inside the question text or image have to stay put
+            if shuffled and questions[idx].get('options'):
+                rng.shuffle(option_order)
+            option_orders.append(option_order)
+        order = (question_order, option_orders)
+        with attempt_orders_lock:
+            attempt_orders[key] = order
+            while len(attempt_orders) > ATTEMPT_ORDER_CACHE:
+                attempt_orders.pop(next(iter(attempt_orders)))
+    return order
+
+def drop_attempt_order(user_id, test_id, result):
+    with attempt_orders_lock:
+        attempt_orders.pop(attempt_order_key(user_id, test_id, result), None)
+
+def canonical_option(option_order, selected_option):
+    idx = ord(selected_option) - 65 if len(selected_option) == 1 else -1
+    if 0 <= idx < len(option_order):
+        return chr(65 + option_order[idx])
+    return selected_option
+
+def question_text(question_data, option_order):
+    options = question_data.get('options')
+    if not options:
+        return question_data['question']
+    lines = [f"{chr(65 + idx)}) {options[option]}" for idx, option in enumerate(option_order)]
+    return '\n'.join(filter(None, [question_data['question'], '\n'.join(lines)]))
+
+def uses_inline_answers(test_id):
+    # Callback data is capped at 64 bytes; longer test IDs fall back to replies
+    return ANSWER_MODE == 'inline' and len(test_id.encode()) <= 48
+
+# Answer keyboards serialized once per option count; telebot sends a string
+# reply_markup as is
+option_keyboards = SHARED_CACHE.setdefault('option_keyboards', {})
+
+def option_keyboard(option_count):
+    if option_count not in option_keyboards:
+        markup = types.ReplyKeyboardMarkup(row_width=1, one_time_keyboard=True)
+        for idx in range(option_count):
+            markup.add(types.KeyboardButton(chr(65 + idx)))
+        option_keyboards[option_count] = markup.to_json()
+    return option_keyboards[option_count]
+
+@lru_cache(maxsize=4096)
+def inline_option_keyboard(test_id, question_index, option_count):
+    markup = types.InlineKeyboardMarkup(row_width=option_count)
+    markup.add(*[
+        types.InlineKeyboardButton(chr(65 + idx), callback_data=f"a:{question_index}:{chr(65 + idx)}:{test_id}")
+        for idx in range(option_count)
+    ])
+    return markup.to_json()
+
+def send_question(chat_id, question_data, option_order, markup, edit_message=None):
+    media = question_data.get('media')
+    text = question_text(question_data, option_order)
+    if edit_message is not None:
+        # Edit the previous question in place when the message kind allows it
+        if media is None and edit_message.content_type == 'text':
+            return bot.edit_message_text(text, chat_id, edit_message.message_id, reply_markup=markup)
+        if media is not None and edit_message.content_type == media['type']:
+            input_media = types.InputMediaPhoto if media['type'] == 'photo' else types.InputMediaDocument
+            return bot.edit_message_media(input_media(media['file_id'], caption=text or None), chat_id, edit_message.message_id, reply_markup=markup)
+        bot.delete_message(chat_id, edit_message.message_id)
+    if media is None:
+        return bot.send_message(chat_id, text, reply_markup=markup)
+    if media['type'] == 'photo':
+        return bot.send_photo(chat_id, media['file_id'], caption=text or None, reply_markup=markup)
+    return bot.send_document(chat_id, media['file_id'], caption=text or None, reply_markup=markup)
+
 def process_answer(message, class_id, test_id, question_index):
+    user_id = str(message.chat.id)
+    result = users[user_id]['tests'].get(test_id)
     if message.text == '⬅Ortga':
+        drop_attempt_order(user_id, test_id, result)
         show_user_main_menu(message)
         return
-    user_id = str(message.chat.id)
-    selected_option = message.text.strip().upper()
+    # Stored under the test's own letters, in the order the questions were shown
+    _, option_orders = attempt_order(user_id, test_id, get_attempt_questions(class_id, tests[class_id][test_id], result), result)
+    selected_option = canonical_option(option_orders[question_index], message.text.strip().upper())
     
-    users[user_id]['tests'][test_id]['answers'].append(selected_option)
+    with user_lock(user_id):
+        users[user_id]['tests'][test_id]['answers'].append(selected_option)
     
     save_json('user.json', users)
     ask_question(message, class_id, test_id, question_index + 1)
 
+def handle_answer_callback(call):
+    # Everything needed is in the callback data and the stored answers, so
+    # no per-user handler has to be kept between questions
+    _, question_index, selected_option, test_id = call.data.split(':', 3)
+    question_index = int(question_index)
+    user_id = str(call.message.chat.id)
+    class_id, test_data = find_test(test_id)
+    current = users[user_id]['tests'].get(test_id) if user_id in users else None
+    questions = get_attempt_questions(class_id, test_data, current) if test_data is not None and user_id in users else []
+    if question_index < len(questions):
+        _, option_orders = attempt_order(user_id, test_id, questions, current)
+        selected_option = canonical_option(option_orders[question_index], selected_option)
+    with user_lock(user_id):
+        result = users[user_id]['tests'].get(test_id) if user_id in users else None
+        # Double taps and taps on an old question are ignored
+        accepted = test_data is not None and result is not None and not result.get('finished') and len(result['answers']) == question_index
+        if accepted:
+            result['answers'].append(selected_option)
+    if not accepted:
+        bot.answer_callback_query(call.id, "Bu savolga javob berilgan.")
+        return
+    bot.answer_callback_query(call.id)
+    save_json('user.json', users)
+    ask_question(call.message, class_id, test_id, question_index + 1, edit_message=call.message)
+
 def calculate_score(message, class_id, test_id):
     user_id = str(message.chat.id)
-    user_answers = users[user_id]['tests'][test_id]['answers']
-    questions = tests[class_id][test_id]['questions']
-    
-    score = sum(1 for user_answer, question in zip(user_answers, questions) if user_answer == question.get('correct_answer'))
-    
-    users[user_id]['tests'][test_id]['score'] = score
+    with user_lock(user_id):
+        result = users[user_id]['tests'][test_id]
+        questions = get_attempt_questions(class_id, tests[class_id][test_id], result)
+        if not result.get('finished') and result.get('shuffled'):
+            # Put the answers back in the test's question order
+            question_order, _ = attempt_order(user_id, test_id, questions, result)
+            answers = [None] * len(questions)
+            for position, answer in enumerate(result['answers'][:len(questions)]):
+                answers[question_order[position]] = answer
+            result['answers'] = answers
+        drop_attempt_order(user_id, test_id, result)
+        user_answers = result['answers']
+        score = sum(1 for user_answer, question in zip(user_answers, questions) if user_answer == question.get('correct_answer'))
+
+        result['score'] = score
+        record_test_score(test_id, user_id, score)
+        # A retried call must not count the same attempt twice
+        if not result.get('finished'):
+            result['finished'] = True
+            record_test_result(test_id, user_answers, questions, score, 1, result.get('questions'))
+            rollup_test_result(users[user_id], test_id, score)
     save_json('user.json', users)
     
     bot.send_message(message.chat.id, f"Test yakunlandi! Sizning balingiz: {score}")
     
-    calculate_rewards(user_id, score, len(questions))
+    calculate_rewards(user_id, score, len(questions), f"reward:{user_id}:{test_id}:{result.get('started', '')}")
     show_user_main_menu(message)
 
-def calculate_rewards(user_id, score, total_questions):
+def calculate_rewards(user_id, score, total_questions, key=None):
     percentage = (score / total_questions) * 100
     rewards = 0
     if percentage > 90:
@@ -587,8 +1944,248 @@ def calculate_rewards(user_id, score, total_questions):
         rewards += 1
     if score == 0:
         rewards -= 5
-    users[user_id]['tanga'] += rewards
-    save_json('user.json', users)
+    # The ledger entry is the durable record; user.json catches up on the
+    # next save or is corrected from the ledger on load
+    post_tanga(user_id, rewards, 'reward' if rewards >= 0 else 'penalty', key)
+
+# Per-test result accumulators, updated by calculate_score in O(questions).
+# Built on first use, like the rollups.
+test_stats = None
+
+def is_test_finished(result, questions):
+    # Archived results keep only the score and are always finished
+    if 'finished' in result:
+        return result['finished']
+    return bool(questions) and len(result['answers']) >= len(questions)
+
+def record_test_result(test_id, answers, questions, score, sign=1, question_ids=None):
+    with stats_lock:
+        if test_stats is None:
+            return
+        stats = test_stats.setdefault(test_id, {'count': 0, 'sum': 0, 'histogram': {}, 'questions': {}})
+        stats['count'] += sign
+        stats['sum'] += sign * score
+        histogram = stats['histogram']
+        histogram[score] = histogram.get(score, 0) + sign
+        if not histogram[score]:
+            del histogram[score]
+        # Pool-based attempts are counted per pool question
+        for idx, (user_answer, question) in enumerate(zip(answers, questions)):
+            counts = stats['questions'].setdefault(str(question_ids[idx] if question_ids else idx), [0, 0])
+            counts[1] += sign
+            if user_answer == question.get('correct_answer'):
+                counts[0] += sign
+
+# Every attempt's score per test, {test_id: {user_id: score}}, for results
+# and rankings. Updated as attempts start and finish, built on first use.
+test_scores = None
+
+def record_test_score(test_id, user_id, score):
+    with stats_lock:
+        if test_scores is not None:
+            test_scores.setdefault(test_id, {})[user_id] = score
+
+def rebuild_test_scores():
+    global test_scores
+    with all_user_locks(), stats_lock:
+        test_scores = {}
+        for user_id, user in users.scan():
+            for test_id, result in user.get('tests', {}).items():
+                test_scores.setdefault(test_id, {})[user_id] = result['score']
+
+def get_test_scores(test_id):
+    if test_scores is None:
+        rebuild_test_scores()
+    with stats_lock:
+        return dict(test_scores.get(test_id, {}))
+
+def user_name(user_id):
+    user = users.peek(user_id)
+    return user.get('name', user_id) if user else user_id
+
+def rebuild_test_stats():
+    global test_stats
+    with all_user_locks(), stats_lock:
+        test_stats = {}
+        archived = {}
+        for user_id, user in users.scan():
+            for test_id, result in user.get('tests', {}).items():
+                if result.get('archived'):
+                    archived.setdefault(test_id, []).append(user_id)
+                    continue
+                class_id, test_data = find_test(test_id)
+                if test_data is None:
+                    continue
+                questions = get_attempt_questions(class_id, test_data, result)
+                if not is_test_finished(result, questions):
+                    continue
+                record_test_result(test_id, result['answers'], questions, result['score'], 1, result.get('questions'))
+        # Archived answers are read once per test, not once per user
+        for test_id, user_ids in archived.items():
+            class_id, test_data = find_test(test_id)
+            archive = load_archive(test_id)
+            if test_data is None or archive is None:
+                continue
+            for user_id in user_ids:
+                entry = archive['results'].get(user_id)
+                if entry is not None:
+                    record_test_result(test_id, entry['answers'], get_attempt_questions(class_id, test_data, entry), entry['score'], 1, entry.get('questions'))
+
+def view_statistics(message):
+    if not is_admin(message.chat.id):
+        bot.send_message(message.chat.id, "Sizda admin huquqlari yo'q.")
+        return
+
+    msg = bot.send_message(message.chat.id, "Iltimos, test ID kiritishingiz kerak:")
+    bot.register_next_step_handler(msg, show_test_statistics)
+
+def show_test_statistics(message):
+    if message.text == '⬅Ortga':
+        back_to_admin_main(message)
+        return
+    test_id = message.text
+    if test_stats is None:
+        rebuild_test_stats()
+    stats = test_stats.get(test_id)
+    if not stats or not stats['count']:
+        bot.send_message(message.chat.id, "Bu test bo'yicha natijalar topilmadi.")
+        return
+
+    average = stats['sum'] / stats['count']
+    distribution = "\n".join([f"{score} ball: {count} ta" for score, count in sorted(stats['histogram'].items(), reverse=True)])
+    question_counts = sorted(stats['questions'].items(), key=lambda x: int(x[0]))
+    _, test_data = find_test(test_id)
+    if test_data is not None and 'pool' in test_data:
+        # Pool tests are counted per pool question; show the most answered ones
+        question_counts = sorted(question_counts, key=lambda x: x[1][1], reverse=True)[:50]
+    correctness = "\n".join([
+        f"{int(idx) + 1}-savol: {correct * 100 // answered}% ({correct}/{answered})"
+        for idx, (correct, answered) in question_counts if answered
+    ])
+    bot.send_message(
+        message.chat.id,
+        f"Test ID: {test_id}\nQatnashchilar: {stats['count']}\nO'rtacha ball: {average:.2f}\n\nBallar taqsimoti:\n{distribution}\n\nTo'g'ri javoblar ulushi:\n{correctness}"
+    )
+
+# Closed tests' answers live in archive/<test_id>.json.gz as
+# {'test_id', 'class_id', 'results': {user_id: {'answers', 'score', 'started', 'questions'}}}.
+# The user record keeps its score with 'archived': True, which is all that
+# results and rankings need.
+ARCHIVE_DIR = data_path('archive')
+archive_lock = threading.Lock()
+
+def archive_filename(test_id):
+    return os.path.join(ARCHIVE_DIR, quote(test_id, safe='') + '.json.gz')
+
+def read_archive(test_id):
+    path = archive_filename(test_id)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return json.loads(gzip.decompress(f.read()))
+
+@lru_cache(maxsize=8)
+def cached_archive(test_id, mtime):
+    return read_archive(test_id)
+
+def load_archive(test_id):
+    # Shared between callers; treat as read-only
+    path = archive_filename(test_id)
+    if not os.path.exists(path):
+        return None
+    return cached_archive(test_id, os.path.getmtime(path))
+
+def closed_tests():
+    now = datetime.datetime.now()
+    closed = {}
+    for class_id, class_tests in list(tests.items()):
+        for test_id, test_data in list(class_tests.items()):
+            if test_data.get('archived') or 'end_time' not in test_data:
+                continue
+            end_time = datetime.datetime.strptime(test_data['end_time'], '%Y-%m-%d %H:%M')
+            # Attempts started before the end can still be finishing
+            if (now - end_time).total_seconds() >= ARCHIVE_AFTER:
+                closed[test_id] = (class_id, test_data)
+    return closed
+
+def archive_closed_tests():
+    with archive_lock:
+        closed = closed_tests()
+        if not closed:
+            return 0
+        # Only users whose stored text mentions a closed test get hydrated
+        candidates = users.ids_mentioning([json.dumps(test_id) for test_id in closed])
+
+        collected = {test_id: {} for test_id in closed}
+        for user_id in candidates:
+            with user_lock(user_id):
+                for test_id, result in users[user_id].get('tests', {}).items():
+                    if test_id not in closed or result.get('archived'):
+                        continue
+                    class_id, test_data = closed[test_id]
+                    if not is_test_finished(result, get_attempt_questions(class_id, test_data, result)):
+                        continue
+                    entry = {'answers': list(result['answers']), 'score': result['score'], 'started': result.get('started')}
+                    if 'questions' in result:
+                        entry['questions'] = list(result['questions'])
+                    collected[test_id][user_id] = entry
+
+        # Write the archives before touching the hot records, so a crash in
+        # between only means the same results are archived again next time
+        os.makedirs(ARCHIVE_DIR, exist_ok=True)
+        for test_id, results in collected.items():
+            class_id, _ = closed[test_id]
+            archive = read_archive(test_id) or {'test_id': test_id, 'class_id': class_id, 'results': {}}
+            archive['results'].update(results)
+            write_atomic(archive_filename(test_id), gzip.compress(json.dumps(archive, separators=(',', ':')).encode()))
+
+        archived = 0
+        for test_id, results in collected.items():
+            for user_id, entry in results.items():
+                with user_lock(user_id):
+                    result = users[user_id]['tests'].get(test_id)
+                    if result is None or result.get('started') != entry['started']:
+                        continue
+                    users[user_id]['tests'][test_id] = {'score': result['score'], 'started': entry['started'], 'finished': True, 'archived': True}
+                    archived += 1
+        save_json('user.json', users)
+        for test_id, (class_id, test_data) in closed.items():
+            test_data['archived'] = True
+        save_json('test_data.json', tests)
+        logging.info(f"Archived {archived} results of {len(closed)} closed tests")
+        return archived
+
+def archive_worker():
+    while True:
+        time.sleep(ARCHIVE_INTERVAL)
+        try:
+            archive_closed_tests()
+        except Exception as e:
+            logging.error(f"Archiving failed: {e}")
+
+def view_archive(message):
+    if not is_admin(message.chat.id):
+        bot.send_message(message.chat.id, "Sizda admin huquqlari yo'q.")
+        return
+
+    msg = bot.send_message(message.chat.id, "Iltimos, test ID kiritishingiz kerak:")
+    bot.register_next_step_handler(msg, show_archived_answers)
+
+def show_archived_answers(message):
+    if message.text == '⬅Ortga':
+        back_to_admin_main(message)
+        return
+    test_id = message.text
+    archive = load_archive(test_id)
+    if archive is None:
+        bot.send_message(message.chat.id, "Bu test arxivda topilmadi.")
+        return
+
+    results = sorted(archive['results'].items(), key=lambda x: x[1]['score'], reverse=True)
+    lines = [f"{rank}. {user_name(user_id)} ({user_id}) - {entry['score']} ball: {' '.join([answer or '-' for answer in entry['answers']])}"
+             for rank, (user_id, entry) in enumerate(results, start=1)]
+    document = types.InputFile(io.BytesIO("\n".join(lines).encode()), file_name=f"{quote(test_id, safe='')}_javoblar.txt")
+    bot.send_document(message.chat.id, document, caption=f"Test ID: {test_id}\nArxivdagi natijalar: {len(results)}")
 
 def view_results(message):
     markup = types.ReplyKeyboardMarkup(row_width=1)
@@ -611,10 +2208,10 @@ def select_result_type(message):
         return
     if message.text == "Chat ID bilan":
         msg = bot.send_message(message.chat.id, "Iltimos, test ID kiritishingiz kerak:")
-        bot.register_next_step_handler(msg, lambda msg: show_admin_results(msg, with_chat_id=True))
+        bot.register_next_step_handler(msg, show_admin_results, True)
     elif message.text == "Chat ID siz":
         msg = bot.send_message(message.chat.id, "Iltimos, test ID kiritishingiz kerak:")
-        bot.register_next_step_handler(msg, lambda msg: show_admin_results(msg, with_chat_id=False))
+        bot.register_next_step_handler(msg, show_admin_results, False)
     else:
         bot.send_message(message.chat.id, "Noto'g'ri tanlov. Iltimos, qaytadan tanlang.")
         view_results(message)
@@ -627,10 +2224,7 @@ def show_admin_results(message, with_chat_id):
         ask_to_join_channels(message)
         return
     test_id = message.text
-    user_scores = [
-        (users[uid]['name'], users[uid]['tests'][test_id]['score'], uid) 
-        for uid in users if test_id in users[uid]['tests']
-    ]
+    user_scores = [(user_name(uid), score, uid) for uid, score in get_test_scores(test_id).items()]
     user_scores.sort(key=lambda x: x[1], reverse=True)
     
     if with_chat_id:
@@ -650,13 +2244,13 @@ def show_user_results(message):
         return
     test_id = message.text
     user_id = str(message.chat.id)
-    if test_id in users[user_id]['tests']:
-        score = users[user_id]['tests'][test_id]['score']
-        user_scores = [users[uid]['tests'][test_id]['score'] for uid in users if test_id in users[uid]['tests']]
-        user_scores.sort(reverse=True)
+    scores = get_test_scores(test_id)
+    if user_id in scores:
+        score = scores[user_id]
+        user_scores = sorted(scores.values(), reverse=True)
         rank = user_scores.index(score) + 1
         bot.send_message(message.chat.id, f"Test ID: {test_id}\nSizning balingiz: {score}\nO'rningiz: {rank}/{len(user_scores)}")
-        send_rankings(message.chat.id, test_id)
+        send_rankings(message.chat.id, test_id, scores)
     else:
         bot.send_message(message.chat.id, "Siz bunday testga qatnashmagansiz.")
 
@@ -708,20 +2302,20 @@ def change_information_step(message):
 def update_name(message):
     user_id = str(message.chat.id)
     new_name = message.text
-    users[user_id]['name'] = new_name
+    with user_lock(user_id):
+        users[user_id]['name'] = new_name
     save_json('user.json', users)
     bot.send_message(message.chat.id, f"Ismingiz muvaffaqiyatli yangilandi: {new_name}")
     show_user_main_menu(message)
 
 def update_region(message):
     user_id = str(message.chat.id)
-    selected_region = message.text
-    if selected_region not in viloyatlar:
-        msg = bot.send_message(message.chat.id, "Noto'g'ri viloyat. Iltimos, qaytadan tanlang:")
+    selected_region, suggestions = match_place(region_index, message.text)
+    if selected_region is None:
+        msg = ask_place_again(message, "Noto'g'ri viloyat. Iltimos, qaytadan tanlang:", suggestions)
         bot.register_next_step_handler(msg, update_region)
         return
-    users[user_id]['region'] = selected_region
-    users[user_id].pop('district', None)
+    update_user_profile(user_id, {'region': selected_region, 'district': None})
     save_json('user.json', users)
     bot.send_message(message.chat.id, f"Viloyatingiz muvaffaqiyatli yangilandi: {selected_region}")
     markup = types.ReplyKeyboardMarkup(row_width=3)
@@ -734,14 +2328,12 @@ def update_region(message):
 
 def update_district(message):
     user_id = str(message.chat.id)
-    selected_district = message.text
-    if 'tuman' not in selected_district.lower():
-        selected_district += ' tuman'
-    if selected_district not in address[users[user_id]['region']]:
-        msg = bot.send_message(message.chat.id, "Noto'g'ri tuman. Iltimos, qaytadan tanlang:")
-        bot.register.next_step_handler(msg, update_district)
-        return
-    users[user_id]['district'] = selected_district
+    selected_district, suggestions = match_place(district_indexes[users[user_id]['region']], message.text)
+    if selected_district is None:
+        msg = ask_place_again(message, "Noto'g'ri tuman. Iltimos, qaytadan tanlang:", suggestions)
+        bot.register_next_step_handler(msg, update_district)
+        return
+    update_user_profile(user_id, {'district': selected_district})
     save_json('user.json', users)
     bot.send_message(message.chat.id, f"Tumaningiz muvaffaqiyatli yangilandi: {selected_district}")
     show_user_main_menu(message)
@@ -782,9 +2374,12 @@ def process_user_view_region(message, selected_class):
         view_users(message)
         return
 
-    selected_region = message.text
-    if selected_region not in viloyatlar:
-        bot.send_message(message.chat.id, "Noto'g'ri viloyat tanlandi. Iltimos, qayta tanlang.")
+    selected_region, suggestions = match_place(region_index, message.text)
+    if selected_region is None:
+        msg = ask_place_again(message, "Noto'g'ri viloyat tanlandi. Iltimos, qayta tanlang.", suggestions)
+        if suggestions:
+            bot.register_next_step_handler(msg, process_user_view_region, selected_class)
+            return
         process_user_view_class(message)
         return
 
@@ -801,16 +2396,17 @@ def process_user_view_district(message, selected_class, selected_region):
         process_user_view_region(message, selected_class)
         return
 
-    selected_district = message.text
-    if 'tuman' not in selected_district.lower():
-        selected_district += ' tuman'
-
-    if selected_district not in address[selected_region]:
-        bot.send_message(message.chat.id, "Noto'g'ri tuman tanlandi. Iltimos, qayta tanlang.")
+    selected_district, suggestions = match_place(district_indexes[selected_region], message.text)
+    if selected_district is None:
+        msg = ask_place_again(message, "Noto'g'ri tuman tanlandi. Iltimos, qayta tanlang.", suggestions)
+        if suggestions:
+            bot.register_next_step_handler(msg, process_user_view_district, selected_class, selected_region)
+            return
         process_user_view_region(message, selected_class)
         return
 
-    user_list = [user for user in users.values() if user.get('class') == int(selected_class) and user.get('region') == selected_region and user.get('district') == selected_district]
+    # Only users whose stored text names the district are parsed
+    user_list = [user for _, user in users.scan([json.dumps(selected_district)]) if user.get('class') == int(selected_class) and user.get('region') == selected_region and user.get('district') == selected_district]
     
     if user_list:
         user_info = "\n\n".join([f"Ism: {user['name']}\nYosh: {user['age']}\nTelefon: {user['phone']}\nSinf: {user['class']}\nViloyat: {user['region']}\nTuman: {user['district']}\nFoydalanuvchi ID: {user['user_id']}\nTanga: {user['tanga']}" for user in user_list])
@@ -820,14 +2416,109 @@ def process_user_view_district(message, selected_class, selected_region):
 
     back_to_admin_main(message)
 
+def format_rollup(title, bucket):
+    if not bucket or not bucket['users']:
+        return f"{title}\nQatnashchilar: 0"
+    averages = "\n".join([
+        f"{test_id}: {total / count:.2f} ({count} ta)"
+        for test_id, (count, total) in sorted(bucket['tests'].items()) if count
+    ]) or "-"
+    return f"{title}\nQatnashchilar: {bucket['users']}\nTangalar: {bucket['tanga']}\nTestlar bo'yicha o'rtacha ball:\n{averages}"
+
+def view_region_statistics(message):
+    if not is_admin(message.chat.id):
+        bot.send_message(message.chat.id, "Sizda admin huquqlari yo'q.")
+        return
+    ensure_rollups()
+
+    markup = types.ReplyKeyboardMarkup(row_width=3, one_time_keyboard=True)
+    markup.add(types.KeyboardButton('Sinflar bo\'yicha'))
+    for region in viloyatlar:
+        markup.add(types.KeyboardButton(region))
+    markup.add(types.KeyboardButton('⬅Ortga'))
+    msg = bot.send_message(message.chat.id, "Viloyatni tanlang:", reply_markup=markup)
+    bot.register_next_step_handler(msg, process_region_statistics)
+
+def process_region_statistics(message):
+    if message.text == '⬅Ortga':
+        back_to_admin_main(message)
+        return
+
+    if message.text == 'Sinflar bo\'yicha':
+        classes = "\n\n".join([
+            format_rollup(f"Sinf: {class_id}", rollups['class'][class_id])
+            for class_id in sorted(rollups['class'], key=int)
+        ]) or "Ma'lumot topilmadi."
+        bot.send_message(message.chat.id, classes)
+        view_region_statistics(message)
+        return
+
+    selected_region, suggestions = match_place(region_index, message.text)
+    if selected_region is None:
+        msg = ask_place_again(message, "Noto'g'ri viloyat tanlandi. Iltimos, qayta tanlang.", suggestions)
+        if suggestions:
+            bot.register_next_step_handler(msg, process_region_statistics)
+            return
+        view_region_statistics(message)
+        return
+
+    bot.send_message(message.chat.id, format_rollup(f"Viloyat: {selected_region}", rollups['region'].get(selected_region)))
+    markup = types.ReplyKeyboardMarkup(row_width=3, one_time_keyboard=True)
+    for district in address[selected_region]:
+        markup.add(types.KeyboardButton(district))
+    markup.add(types.KeyboardButton('⬅Ortga'))
+    msg = bot.send_message(message.chat.id, "Tumanni tanlang:", reply_markup=markup)
+    bot.register_next_step_handler(msg, process_district_statistics, selected_region)
+
+def process_district_statistics(message, selected_region):
+    if message.text == '⬅Ortga':
+        view_region_statistics(message)
+        return
+
+    selected_district, suggestions = match_place(district_indexes[selected_region], message.text)
+    if selected_district is None:
+        msg = ask_place_again(message, "Noto'g'ri tuman tanlandi. Iltimos, qayta tanlang.", suggestions)
+        if suggestions:
+            bot.register_next_step_handler(msg, process_district_statistics, selected_region)
+            return
+        view_region_statistics(message)
+        return
+
+    bucket = rollups['district'].get(f"{selected_region}|{selected_district}")
+    bot.send_message(message.chat.id, format_rollup(f"Viloyat: {selected_region}\nTuman: {selected_district}", bucket))
+    back_to_admin_main(message)
+
 def view_tanga(message):
     if not check_channel_subscription(message.chat.id):
         ask_to_join_channels(message)
         return
     user_id = str(message.chat.id)
-    tanga = users[user_id]['tanga']
+    tanga = tanga_balance(user_id)
     bot.send_message(message.chat.id, f"Sizning tangalaringiz soni: {tanga}")
 
+def view_slow_handlers(message):
+    if not is_admin(message.chat.id):
+        bot.send_message(message.chat.id, "Sizda admin huquqlari yo'q.")
+        return
+    if not PROFILE_HANDLERS:
+        bot.send_message(message.chat.id, "Profillash o'chirilgan. Yoqish uchun PROFILE_HANDLERS=1 bilan ishga tushiring.")
+        return
+
+    report = slow_handler_report() or f"{PROFILE_THRESHOLD * 1000:.0f} ms dan sekin handlerlar yo'q."
+    # Telegram messages are capped at 4096 characters
+    bot.send_message(message.chat.id, report[:4000])
+
+def view_top_holders(message):
+    if not is_admin(message.chat.id):
+        bot.send_message(message.chat.id, "Sizda admin huquqlari yo'q.")
+        return
+
+    rankings = "\n".join([
+        f"{rank}. {user_name(user_id)} - {balance} tanga"
+        for rank, (user_id, balance) in enumerate(get_top_holders(10), start=1)
+    ]) or "Hozircha tangalar yo'q."
+    bot.send_message(message.chat.id, f"Eng ko'p tangaga ega foydalanuvchilar:\n{rankings}")
+
 def handle_give_tanga(message):
     if not is_admin(message.chat.id):
         bot.send_message(message.chat.id, "Sizda admin huquqlari yo'q.")
@@ -857,7 +2548,7 @@ def process_tanga_amount(message, user_id):
     try:
         tanga_amount = int(message.text.strip())
         
-        users[user_id]['tanga'] += tanga_amount
+        post_tanga(user_id, tanga_amount, 'grant', f"grant:{message.chat.id}:{message.message_id}")
         save_json('user.json', users)
         bot.send_message(message.chat.id, f"{users[user_id]['name']} foydalanuvchisiga {tanga_amount} tanga berildi.")
     except ValueError:
@@ -868,19 +2559,19 @@ def process_tanga_amount(message, user_id):
 
     back_to_admin_main(message)
 
-def send_rankings(chat_id, test_id):
-    user_scores = [(uid, users[uid]['name'], users[uid]['tests'][test_id]['score']) for uid in users if test_id in users[uid]['tests']]
-    user_scores.sort(key=lambda x: x[2], reverse=True)
+def send_rankings(chat_id, test_id, scores=None):
+    if scores is None:
+        scores = get_test_scores(test_id)
+    user_scores = sorted(scores.items(), key=lambda x: x[1], reverse=True)
     top_10 = user_scores[:10]
     user_id = str(chat_id)
-    user_rank = next((rank + 1 for rank, (uid, _, _) in enumerate(user_scores) if uid == user_id), None)
+    user_rank = next((rank + 1 for rank, (uid, _) in enumerate(user_scores) if uid == user_id), None)
     rankings = "Top 10:\n"
-    for rank, (uid, name, score) in enumerate(top_10, start=1):
-        rankings += f"{rank}. {name} - {score} ball\n"
+    for rank, (uid, score) in enumerate(top_10, start=1):
+        rankings += f"{rank}. {user_name(uid)} - {score} ball\n"
     if user_rank and user_rank > 10:
         rankings += "...\n"
-        user_score = next(score for uid, name, score in user_scores if uid == user_id)
-        rankings += f"{user_rank}. {users[user_id]['name']} - {user_score} ball\n"
+        rankings += f"{user_rank}. {user_name(user_id)} - {scores[user_id]} ball\n"
     bot.send_message(chat_id, f"Test ID: {test_id}\nNatijalar:\n{rankings}")
 
 def manage_channels(message):
@@ -910,9 +2601,12 @@ def process_add_channel(message):
         return
     
     channel_username = message.text.strip().replace("@", "")
-    if channel_username not in required_channels:
-        required_channels.append(channel_username)
-        save_json('channels.json', required_channels)
+    with channels_lock:
+        added = channel_username not in required_channels
+        if added:
+            required_channels.append(channel_username)
+            save_json('channels.json', required_channels)
+    if added:
         bot.send_message(message.chat.id, f"Kanal @{channel_username} muvaffaqiyatli qo'shildi.")
     else:
         bot.send_message(message.chat.id, f"Kanal @{channel_username} allaqachon mavjud.")
@@ -932,9 +2626,12 @@ def process_remove_channel(message):
         return
     
     channel_username = message.text.strip().replace("@", "")
-    if channel_username in required_channels:
-        required_channels.remove(channel_username)
-        save_json('channels.json', required_channels)
+    with channels_lock:
+        removed = channel_username in required_channels
+        if removed:
+            required_channels.remove(channel_username)
+            save_json('channels.json', required_channels)
+    if removed:
         bot.send_message(message.chat.id, f"Kanal @{channel_username} muvaffaqiyatli o'chirildi.")
     else:
         bot.send_message(message.chat.id, f"Kanal @{channel_username} topilmadi.")
@@ -966,7 +2663,7 @@ def process_broadcast_message(message):
         return
     
     text = message.text
-    for user_id in users:
+    for user_id in list(users):
         try:
             bot.send_message(user_id, text)
         except Exception as e:
@@ -974,10 +2671,18 @@ def process_broadcast_message(message):
     bot.send_message(message.chat.id, "Xabar barcha foydalanuvchilarga yuborildi.")
     back_to_admin_main(message)
 
+@bot.callback_query_handler(func=lambda call: call.data.startswith('a:'))
+def handle_answer_button(call):
+    handle_answer_callback(call)
+
 @bot.message_handler(commands=['start'])
 def handle_start(message):
     ensure_user_info(message)
 
+@bot.message_handler(commands=['slow'])
+def handle_view_slow_handlers(message):
+    view_slow_handlers(message)
+
 @bot.message_handler(commands=['admin_start'])
 def handle_admin_start(message):
     admin_panel(message)
@@ -1045,6 +2750,10 @@ def handle_remove_admin_step(message):
 def handle_view_admins_list(message):
     view_admins_list(message)
 
+@bot.message_handler(func=lambda message: message.text in ('Test muallifi qo\'shish', 'Test muallifini o\'chirish'))
+def handle_author_step(message):
+    author_step(message)
+
 @bot.message_handler(func=lambda message: message.text == 'Ismni o\'zgartirish')
 def handle_change_name(message):
     change_information_step(message)
@@ -1069,5 +2778,96 @@ def handle_give_tanga_button(message):
 def handle_broadcast_message(message):
     broadcast_message(message)
 
+@bot.message_handler(func=lambda message: message.text == '📈 Statistika')
+def handle_view_statistics(message):
+    view_statistics(message)
+
+@bot.message_handler(func=lambda message: message.text == '🗺 Hududlar statistikasi')
+def handle_view_region_statistics(message):
+    view_region_statistics(message)
+
+@bot.message_handler(func=lambda message: message.text == '🏆 Top tangalar')
+def handle_view_top_holders(message):
+    view_top_holders(message)
+
+@bot.message_handler(func=lambda message: message.text == '📥 Savollar hovuzi')
+def handle_import_pool(message):
+    question_pool_menu(message, 'import')
+
+@bot.message_handler(func=lambda message: message.text == '🎲 Hovuzdan test')
+def handle_pool_test(message):
+    question_pool_menu(message, 'define')
+
+@bot.message_handler(func=lambda message: message.text == '📦 Arxiv')
+def handle_view_archive(message):
+    view_archive(message)
+
+# Lifecycle: SIGTERM or SIGINT stops polling once the current getUpdates
+# returns. Every update received by then is handled, state is flushed, and the
+# next update offset and pending next-step handlers are saved, so the next
+# instance continues from the same update with the same conversations.
+OFFSET_FILE = data_path('offset.json')
+STEP_HANDLERS_FILE = data_path(os.path.join('.handler-saves', 'step.save'))
+
+def request_shutdown(signum, frame):
+    logging.info(f"Signal {signum} received, stopping polling")
+    bot.stop_polling()
+
+def drain_workers():
+    pool = bot.worker_pool
+    deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+    while not pool.tasks.empty() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    for worker in pool.workers:
+        worker.stop()
+    for worker in pool.workers:
+        worker.join(max(0, deadline - time.monotonic()))
+    if not pool.tasks.empty() or any(worker.is_alive() for worker in pool.workers):
+        logging.error(f"Handlers still running after {SHUTDOWN_TIMEOUT} s, their updates may be lost")
+        return False
+    return True
+
+def restore_state():
+    bot.last_update_id = load_json(OFFSET_FILE).get('last_update_id', 0)
+    saved_handlers = FileHandlerBackend.return_load_handlers(STEP_HANDLERS_FILE)
+    if saved_handlers:
+        bot.next_step_backend.handlers.update(saved_handlers)
+
+def run():
+    restore_state()
+    signal.signal(signal.SIGTERM, request_shutdown)
+    signal.signal(signal.SIGINT, request_shutdown)
+    threading.Thread(target=archive_worker, daemon=True).start()
+    logging.info(f"Polling from update {bot.last_update_id + 1}")
+    bot.infinity_polling(none_stop=True, long_polling_timeout=POLL_TIMEOUT)
+    shutdown()
+
+def shutdown():
+    if not TENANT_CONFIG:
+        # A second signal ends the process without waiting
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+    drained = drain_workers() if bot.threaded else True
+    # Wait for a running archive pass; nothing else writes from here on
+    with archive_lock:
+        save_json('user.json', users, snapshot=True)
+        save_json('test_data.json', tests)
+        save_json('channels.json', required_channels)
+        save_json('pools.json', pools)
+        with ledger_lock:
+            ledger_file.flush()
+            os.fsync(ledger_file.fileno())
+        FileHandlerBackend.dump_handlers(bot.next_step_backend.handlers, STEP_HANDLERS_FILE)
+        # Written last: an offset on disk means everything before it is
+        # saved, so it stays behind when handlers were cut off. That does not
+        # bring their updates back: each getUpdates confirms the batches
+        # before it, so only the last batch, never confirmed, comes again
+        if not drained:
+            logging.error(f"Keeping the previous offset: handlers were cut off, updates up to {bot.last_update_id} that Telegram already confirmed are lost")
+            return
+        save_json(OFFSET_FILE, {'last_update_id': bot.last_update_id})
+    logging.info(f"Stopped after update {bot.last_update_id}")
+
 # Start the bot
-bot.infinity_polling(none_stop=True)
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,240 @@
+import os
+import sys
+import json
+import heapq
+import signal
+import time
+import logging
+import itertools
+import threading
+import importlib.util
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+
+# Runs several bots from one process. tenants.json lists one entry per bot:
+#
+#   [{"name": "maktab1", "token": "...", "main_admin_id": "123", "data_dir": "data/maktab1"}, ...]
+#
+# Every tenant gets its own copy of main.py's module state (users, tests,
+# ledger, step handlers) stored under its data_dir, while address.json and
+# the indexes and keyboards built from it are loaded once and shared. All
+# tenants poll on POLL_THREADS threads and run handlers on WORKER_THREADS
+# threads instead of telebot's pool of workers per bot.
+#
+# A long poll holds its thread for up to POLL_TIMEOUT, so tenants long-poll
+# only while there is a poll thread for each of them. With more tenants they
+# short-poll instead: a tenant with nothing new is polled again POLL_INTERVAL
+# later without holding a thread, so a message waits up to about
+# POLL_INTERVAL plus one round of polls.
+#
+# Polling never waits for handlers. Each chat's updates run one at a time in
+# order, different chats in parallel. Telegram drops every update below the
+# offset asked for, so polls always ask from the oldest unhandled update:
+# updates still in flight come back and are skipped, and since Telegram
+# returns at most 100 updates, at most 100 per tenant are ever in flight.
+# Handled updates after an unhandled one can run again after a restart.
+#
+#   python tenants.py [tenants.json]
+
+load_dotenv()
+logging.basicConfig(level=logging.INFO)
+
+MAIN_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+TENANTS_FILE = sys.argv[1] if len(sys.argv) > 1 else os.getenv('TENANTS_FILE', 'tenants.json')
+ADDRESS_FILE = os.getenv('ADDRESS_FILE', 'address.json')
+POLL_THREADS = int(os.getenv('POLL_THREADS', '8'))
+WORKER_THREADS = int(os.getenv('WORKER_THREADS', '8'))
+POLL_TIMEOUT = int(os.getenv('POLL_TIMEOUT', '10'))
+POLL_RETRY = float(os.getenv('POLL_RETRY', '3'))
+POLL_INTERVAL = float(os.getenv('POLL_INTERVAL', '0.5'))
+ARCHIVE_INTERVAL = int(os.getenv('ARCHIVE_INTERVAL', '3600'))
+SHUTDOWN_TIMEOUT = float(os.getenv('SHUTDOWN_TIMEOUT', '25'))
+
+stopping = threading.Event()
+# (due, seq, state) of tenants waiting for their next poll
+scheduled = []
+schedule_cond = threading.Condition()
+schedule_seq = itertools.count()
+
+def load_tenants():
+    with open(TENANTS_FILE, 'r', encoding='utf-8') as f:
+        tenants = json.load(f)
+    names = [tenant['name'] for tenant in tenants]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Duplicate tenant names in {TENANTS_FILE}")
+    return tenants
+
+def shared_cache():
+    try:
+        with open(ADDRESS_FILE, 'r', encoding='utf-8') as f:
+            return {'address': json.load(f)}
+    except FileNotFoundError:
+        logging.warning(f"{ADDRESS_FILE} not found, tenants start without regions")
+        return {'address': {}}
+
+def load_tenant(tenant, cache):
+    module_name = f"quiz_tenant_{tenant['name']}"
+    spec = importlib.util.spec_from_file_location(module_name, MAIN_FILE)
+    module = importlib.util.module_from_spec(spec)
+    module.TENANT_CONFIG = {
+        'token': tenant['token'],
+        'main_admin_id': str(tenant['main_admin_id']),
+        'data_dir': tenant.get('data_dir', os.path.join('data', tenant['name'])),
+        # Handlers run on the shared worker pool, not on a pool per bot
+        'threaded': False,
+    }
+    module.SHARED_CACHE = cache
+    # Saved next-step handlers are pickled by module name
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    module.restore_state()
+    return module
+
+def update_chat(update):
+    if update.message:
+        return update.message.chat.id
+    if update.callback_query:
+        return update.callback_query.from_user.id
+    return None
+
+def new_state(module, poll_timeout):
+    # fetched: last update id taken from Telegram; pending: ids taken but not
+    # yet handled; chats: queued updates of chats that have a run_chat going
+    return {'module': module, 'lock': threading.Lock(), 'fetched': module.bot.last_update_id, 'pending': set(), 'chats': {}, 'poll_timeout': poll_timeout}
+
+def committed_offset(state):
+    with state['lock']:
+        if state['pending']:
+            return min(state['pending']) - 1
+        return state['fetched']
+
+def run_chat(state, chat):
+    module = state['module']
+    while True:
+        with state['lock']:
+            queue = state['chats'][chat]
+            if not queue:
+                del state['chats'][chat]
+                return
+            update = queue.popleft()
+        # One failing update must not take the rest of the chat's with it
+        try:
+            module.bot.process_new_updates([update])
+        except Exception as e:
+            logging.error(f"{module.__name__}: handler failed for update {update.update_id}: {e}")
+        with state['lock']:
+            state['pending'].discard(update.update_id)
+
+def poll(state, pollers, workers):
+    if stopping.is_set():
+        return
+    module = state['module']
+    try:
+        updates = module.bot.get_updates(offset=committed_offset(state) + 1, timeout=state['poll_timeout'] + 5, long_polling_timeout=state['poll_timeout'])
+    except Exception as e:
+        logging.error(f"{module.__name__}: getUpdates failed: {e}")
+        schedule_poll(state, POLL_RETRY)
+        return
+    started = []
+    with state['lock']:
+        for update in updates:
+            # Already queued or handled
+            if update.update_id <= state['fetched']:
+                continue
+            state['fetched'] = update.update_id
+            state['pending'].add(update.update_id)
+            chat = update_chat(update)
+            # A chat with a queue already has a run_chat that will get to it
+            if chat not in state['chats']:
+                state['chats'][chat] = deque()
+                started.append(chat)
+            state['chats'][chat].append(update)
+    for chat in started:
+        workers.submit(run_chat, state, chat)
+    # Poll again at once after new updates or a long poll that waited them
+    # out; short polls and polls that only returned updates still in flight
+    # wait POLL_INTERVAL
+    if started or (not updates and state['poll_timeout']):
+        submit_poll(state, pollers, workers)
+    else:
+        schedule_poll(state, POLL_INTERVAL)
+
+def submit_poll(state, pollers, workers):
+    if stopping.is_set():
+        return
+    try:
+        pollers.submit(poll, state, pollers, workers)
+    except RuntimeError:
+        # Shutting down
+        pass
+
+def schedule_poll(state, delay):
+    with schedule_cond:
+        heapq.heappush(scheduled, (time.monotonic() + delay, next(schedule_seq), state))
+        schedule_cond.notify()
+
+def poll_scheduler(pollers, workers):
+    while not stopping.is_set():
+        with schedule_cond:
+            wait = scheduled[0][0] - time.monotonic() if scheduled else 1
+            if wait > 0:
+                schedule_cond.wait(min(wait, 1))
+                continue
+            _, _, state = heapq.heappop(scheduled)
+        submit_poll(state, pollers, workers)
+
+def archive_worker(modules):
+    while not stopping.wait(ARCHIVE_INTERVAL):
+        for module in modules:
+            try:
+                module.archive_closed_tests()
+            except Exception as e:
+                logging.error(f"{module.__name__}: archiving failed: {e}")
+
+def request_shutdown(signum, frame):
+    logging.info(f"Signal {signum} received, stopping polling")
+    stopping.set()
+
+def main():
+    tenants = load_tenants()
+    cache = shared_cache()
+    modules = [load_tenant(tenant, cache) for tenant in tenants]
+    poll_timeout = POLL_TIMEOUT if POLL_THREADS >= len(modules) else 0
+    if not poll_timeout:
+        logging.info(f"{len(modules)} tenants on {POLL_THREADS} poll threads, short polling every {POLL_INTERVAL} s")
+    states = [new_state(module, poll_timeout) for module in modules]
+    pollers = ThreadPoolExecutor(max_workers=POLL_THREADS, thread_name_prefix='poll')
+    workers = ThreadPoolExecutor(max_workers=WORKER_THREADS, thread_name_prefix='worker')
+
+    signal.signal(signal.SIGTERM, request_shutdown)
+    signal.signal(signal.SIGINT, request_shutdown)
+    threading.Thread(target=archive_worker, args=(modules,), daemon=True).start()
+    threading.Thread(target=poll_scheduler, args=(pollers, workers), daemon=True).start()
+    for state in states:
+        logging.info(f"{state['module'].__name__}: polling from update {state['fetched'] + 1}")
+        submit_poll(state, pollers, workers)
+    while not stopping.wait(1):
+        pass
+
+    # A second signal ends the process without waiting
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    # Running long polls return within POLL_TIMEOUT; their updates still
+    # reach the workers, which get SHUTDOWN_TIMEOUT to finish the queues
+    pollers.shutdown(wait=True)
+    deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+    while any(committed_offset(state) < state['fetched'] for state in states) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    workers.shutdown(wait=False, cancel_futures=True)
+    for state in states:
+        module = state['module']
+        # Nothing from here on has been confirmed to Telegram, so the next
+        # start fetches the unhandled updates again
+        module.bot.last_update_id = committed_offset(state)
+        if module.bot.last_update_id < state['fetched']:
+            logging.error(f"{module.__name__}: updates after {module.bot.last_update_id} were not handled within {SHUTDOWN_TIMEOUT} s")
+        module.shutdown()
+
+if __name__ == '__main__':
+    main()